@@ -0,0 +1,117 @@
+# encoding: utf-8
+"""Benchmark of the async views under ASGI against the views under WSGI
+
+Both run in process with the test clients, that go through the WSGI and the
+ASGI handlers, with the same number of concurrent requests to /settleup.
+
+Run it from the project directory with: python -m benchmarks.async_views
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import setup
+
+
+def populate(users, debts):
+    """Create the users and random debts between them"""
+
+    from django.utils import timezone
+
+    from debts.models import Debt, User
+
+    User.objects.bulk_create(User(username=f"user{i}") for i in range(users))
+    generator = random.Random(46)
+    entries = []
+    for _ in range(debts):
+        lender, borrower = generator.sample(range(users), 2)
+        entries.append(
+            {
+                "lender": f"user{lender}",
+                "borrower": f"user{borrower}",
+                "amount": generator.randint(1, 10000) / 100,
+                "expiration_date": timezone.now(),
+            }
+        )
+    Debt.bulk_record(entries)
+
+
+def paths(users, requests, users_per_request, seed=46):
+    """Return the paths of the requests to /settleup"""
+
+    generator = random.Random(seed)
+    paths = []
+    for _ in range(requests):
+        sample = generator.sample(range(users), users_per_request)
+        paths.append("/settleup?users=" + ",".join(f"user{i}" for i in sample))
+    return paths
+
+
+def run_wsgi(paths, concurrency):
+    """Send the requests to the synchronous views with threads"""
+
+    from django.db import connections
+    from django.test import Client
+
+    def send(path):
+        response = Client().get(path)
+        assert response.status_code == 200
+        connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, paths))
+
+
+def run_asgi(paths, concurrency):
+    """Send the requests to the async views with tasks"""
+
+    from django.test import AsyncClient
+
+    async def main():
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(path):
+            async with semaphore:
+                response = await client.get("/async" + path)
+                assert response.status_code == 200
+
+        await asyncio.gather(*(send(path) for path in paths))
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--debts", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--users-per-request", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    arguments = parser.parse_args()
+
+    path = setup()
+    try:
+        populate(arguments.users, arguments.debts)
+        requests = paths(
+            arguments.users, arguments.requests, arguments.users_per_request
+        )
+        for concurrency in arguments.concurrency:
+            for name, run in [("wsgi", run_wsgi), ("asgi", run_asgi)]:
+                start = time.perf_counter()
+                run(requests, concurrency)
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{name}  concurrency {concurrency:>4}  "
+                    f"{len(requests) / elapsed:>8.1f} requests/s"
+                )
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
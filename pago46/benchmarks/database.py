@@ -0,0 +1,34 @@
+# encoding: utf-8
+"""Database of the benchmarks"""
+
+import logging
+import os
+import tempfile
+
+import django
+
+
+def setup(path=None):
+    """Configure Django with a SQLite database file and create its tables
+
+    Without a path a new temporary file is used. Returns the path of the database.
+    """
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pago46.settings")
+
+    from django.conf import settings
+
+    if path is None:
+        file, path = tempfile.mkstemp(prefix="pago46-benchmark-", suffix=".sqlite3")
+        os.close(file)
+    settings.DATABASES["default"]["NAME"] = path
+    # The requests of the test clients are sent to testserver
+    settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "testserver"]
+    django.setup()
+    # The timing of every request isn't logged during the benchmarks
+    logging.getLogger("debts.timing").setLevel(logging.WARNING)
+
+    from django.core.management import call_command
+
+    call_command("migrate", verbosity=0)
+    return path
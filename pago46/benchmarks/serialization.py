@@ -0,0 +1,94 @@
+# encoding: utf-8
+"""Benchmark of the serialization of the user objects of settleup
+
+Run it from the project directory with: python -m benchmarks.serialization
+"""
+
+import argparse
+import os
+import random
+import time
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pago46.settings")
+django.setup()
+
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from debts import renderers  # noqa: E402
+
+
+def random_rows(users, debts_per_user, seed=46):
+    """Return random (name, owes, owed_by, balance) rows of the users"""
+
+    generator = random.Random(seed)
+    rows = []
+    for i in range(users):
+        owes, owed_by = {}, {}
+        for _ in range(debts_per_user):
+            other = f"user{generator.randrange(users)}"
+            amount = Decimal(generator.randint(1, 100000)) / 100
+            (owes if generator.random() < 0.5 else owed_by)[other] = amount
+        balance = sum(owed_by.values()) - sum(owes.values())
+        rows.append((f"user{i}", owes, owed_by, balance))
+    return rows
+
+
+def measure(render, repeat):
+    """Return the best time in ms of the render and the size of its output"""
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        content = render()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, len(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--debts", type=int, default=5, help="Debts of every user")
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args()
+
+    rows = random_rows(arguments.users, arguments.debts)
+    user_rows = renderers.UserRowsRenderer()
+
+    def drf():
+        user_objects = [
+            {"name": name, "owes": owes, "owed_by": owed_by, "balance": balance}
+            for name, owes, owed_by, balance in rows
+        ]
+        return JSONRenderer().render(user_objects)
+
+    def report(label, render):
+        elapsed, size = measure(render, arguments.repeat)
+        print(
+            f"{label:<15} {arguments.users:>7} users {size:>10} bytes "
+            f"{elapsed:>10.1f} ms"
+        )
+
+    report("drf", drf)
+    orjson = renderers.orjson
+    encoders = [("orjson", orjson), ("json", None)] if orjson else [("json", None)]
+    try:
+        for encoder, module in encoders:
+            renderers.orjson = module
+            for name, amount in (
+                ("compact", renderers.fixed_point),
+                ("cents", renderers.cents),
+            ):
+                report(
+                    f"{name} {encoder}",
+                    lambda: renderers.dumps(user_rows.user_objects(rows, amount)),
+                )
+    finally:
+        renderers.orjson = orjson
+
+
+if __name__ == "__main__":
+    main()
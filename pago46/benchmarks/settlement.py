@@ -0,0 +1,60 @@
+# encoding: utf-8
+"""Benchmark of the settlement planner
+
+Run it from the project directory with: python -m benchmarks.settlement
+"""
+
+import argparse
+import os
+import random
+import time
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pago46.settings")
+django.setup()
+
+from debts.settlement import plan_transfers  # noqa: E402
+
+
+def random_balances(users, seed=46):
+    """Return random balances of the users that sum zero"""
+
+    generator = random.Random(seed)
+    balances = {
+        f"user{i}": Decimal(generator.randint(-100000, 100000)) / 100
+        for i in range(users)
+    }
+    balances["user0"] -= sum(balances.values())
+    return balances
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--exact-users", type=int, default=12)
+    arguments = parser.parse_args()
+
+    balances = random_balances(arguments.exact_users)
+    start = time.perf_counter()
+    transfers = plan_transfers(balances, exact=True)
+    elapsed = time.perf_counter() - start
+    print(
+        f"exact   {arguments.exact_users:>7} users {len(transfers):>7} transfers "
+        f"{elapsed * 1000:>10.1f} ms"
+    )
+
+    for users in arguments.users:
+        balances = random_balances(users)
+        start = time.perf_counter()
+        transfers = plan_transfers(balances, exact=False)
+        elapsed = time.perf_counter() - start
+        print(
+            f"greedy  {users:>7} users {len(transfers):>7} transfers "
+            f"{elapsed * 1000:>10.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
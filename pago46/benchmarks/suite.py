@@ -0,0 +1,289 @@
+# encoding: utf-8
+"""Benchmark suite of the debts endpoints
+
+Creates a graph of users and debts with the factories in a new SQLite database,
+where a few users take part in most of the debts, and measures the latency
+percentiles, the number of queries and the peak of memory of the requests to
+/settleup, /iou, /add and the expired_iou GraphQL query. The results are saved
+as JSON to compare them between commits.
+
+Run it from the project directory with:
+
+    python -m benchmarks.suite --scale 1k --output results.json
+    python -m benchmarks.suite --scale 1k --compare results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+from .database import setup
+
+# Number of users and debts of every scale
+SCALES = {
+    "1k": (200, 1_000),
+    "100k": (20_000, 100_000),
+    "1M": (200_000, 1_000_000),
+}
+
+BATCH_SIZE = 10_000
+
+# Requests of every endpoint sent to measure the peak of memory
+MEMORY_REQUESTS = 10
+
+
+def skewed_index(generator, size):
+    """Return a random index where the first indexes are much more frequent"""
+
+    return int(size * generator.random() ** 3)
+
+
+def generate(users, debts, seed=46):
+    """Create the users and the debts and rebuild the accumulated debts"""
+
+    from debts.factories import DebtFactory, UserFactory
+    from debts.models import Debt, DebtAccumulate, User, UserBalance
+
+    UserFactory.reset_sequence()
+    for start in range(0, users, BATCH_SIZE):
+        User.objects.bulk_create(
+            UserFactory.build_batch(min(BATCH_SIZE, users - start)),
+            batch_size=1000,
+        )
+    ids = list(User.objects.order_by("id").values_list("id", flat=True))
+
+    generator = random.Random(seed)
+    for start in range(0, debts, BATCH_SIZE):
+        batch = []
+        for _ in range(min(BATCH_SIZE, debts - start)):
+            lender = skewed_index(generator, users)
+            borrower = skewed_index(generator, users - 1)
+            if borrower >= lender:
+                borrower += 1
+            batch.append(
+                DebtFactory.build(lender_id=ids[lender], borrower_id=ids[borrower])
+            )
+        Debt.objects.bulk_create(batch, batch_size=1000)
+
+    DebtAccumulate.rebuild()
+    UserBalance.rebuild()
+
+
+def percentile(values, percent):
+    """Return the percentile of the sorted values"""
+
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def measure(send, requests, warm_cache=False):
+    """Send the requests and return their latencies, queries and peak of memory
+
+    Tracing the memory slows down the requests, so the peak is measured with the
+    last MEMORY_REQUESTS requests and the latencies with the rest.
+    """
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from debts import cache
+
+    def send_request(request):
+        if not warm_cache:
+            cache.invalidate()
+        response = send(request)
+        assert response.status_code == 200, response.content
+
+    latencies = []
+    queries = []
+    for request in requests[:-MEMORY_REQUESTS]:
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            send_request(request)
+            latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(len(context.captured_queries))
+
+    tracemalloc.start()
+    for request in requests[-MEMORY_REQUESTS:]:
+        send_request(request)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p90": round(percentile(latencies, 90), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "queries": {"mean": statistics.mean(queries), "max": max(queries)},
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+def run(users, requests, warm_cache=False, seed=46):
+    """Return the results of every endpoint"""
+
+    from django.test import Client
+    from django.utils import timezone
+
+    # The arguments of the requests of the latencies and of the memory
+    requests += MEMORY_REQUESTS
+
+    client = Client()
+    generator = random.Random(seed)
+
+    def sample(size):
+        return [f"user{skewed_index(generator, users)}" for _ in range(size)]
+
+    def iou(names):
+        lender, borrower = names
+        data = {
+            "lender": lender,
+            "borrower": borrower,
+            "amount": generator.randint(1, 10000) / 100,
+            "expiration": "2022-11-20",
+        }
+        return client.post("/iou", data, content_type="application/json")
+
+    expired_query = """
+        query ($datetime: DateTime!) {
+            expiredDebtsConnection(datetime: $datetime, first: 20) {
+                edges { node { amount lender { username } borrower { username } } }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    """
+
+    pairs = []
+    while len(pairs) < requests:
+        names = sample(2)
+        if names[0] != names[1]:
+            pairs.append(names)
+
+    endpoints = {
+        "settleup_page": (
+            lambda _: client.get("/settleup", {"page_size": 100}),
+            range(requests),
+        ),
+        "settleup_users": (
+            lambda names: client.get("/settleup", {"users": ",".join(names)}),
+            [sample(20) for _ in range(requests)],
+        ),
+        "iou": (iou, pairs),
+        "add": (
+            lambda index: client.post(
+                "/add", {"user": f"new_user{index}"}, content_type="application/json"
+            ),
+            range(requests),
+        ),
+        "expired_iou": (
+            lambda _: client.post(
+                "/expired_iou",
+                {
+                    "query": expired_query,
+                    "variables": {"datetime": timezone.now().isoformat()},
+                },
+                content_type="application/json",
+            ),
+            range(requests),
+        ),
+    }
+    return {
+        name: measure(send, list(arguments), warm_cache)
+        for name, (send, arguments) in endpoints.items()
+    }
+
+
+def git_commit():
+    """Return the current commit, or None outside of a repository"""
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Print the change of the p50 latency and the queries of every endpoint"""
+
+    print(f"\nCompared with {previous.get('commit')} ({previous['scale']} scale)")
+    for name, result in results["endpoints"].items():
+        before = previous["endpoints"].get(name)
+        if not before:
+            continue
+        latency = result["latency_ms"]["p50"] / before["latency_ms"]["p50"]
+        print(
+            f"{name:<16} p50 x{latency:>6.2f}  queries "
+            f"{before['queries']['mean']:.1f} -> {result['queries']['mean']:.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--warm-cache",
+        action="store_true",
+        help="Keep the cached user objects between requests",
+    )
+    parser.add_argument("--output", help="File where the results are saved")
+    parser.add_argument("--compare", help="File with previous results to compare")
+    arguments = parser.parse_args()
+
+    users, debts = SCALES[arguments.scale]
+    path = setup()
+    try:
+        start = time.perf_counter()
+        generate(users, debts)
+        setup_seconds = time.perf_counter() - start
+
+        results = {
+            "commit": git_commit(),
+            "scale": arguments.scale,
+            "users": users,
+            "debts": debts,
+            "python": platform.python_version(),
+            "warm_cache": arguments.warm_cache,
+            "setup_seconds": round(setup_seconds, 2),
+            "endpoints": run(users, arguments.requests, arguments.warm_cache),
+        }
+    finally:
+        os.remove(path)
+
+    print(f"{users} users, {debts} debts, created in {setup_seconds:.1f}s")
+    for name, result in results["endpoints"].items():
+        latency = result["latency_ms"]
+        queries = result["queries"]["mean"]
+        print(
+            f"{name:<16} p50 {latency['p50']:>8.2f} ms  p90 {latency['p90']:>8.2f} ms  "
+            f"p99 {latency['p99']:>8.2f} ms  queries {queries:>5.1f}  "
+            f"peak {result['peak_memory_kb']:>9.1f} KB"
+        )
+
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DebtsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'debts'
+
+    def ready(self):
+        # Connect the receivers of the signals
+        from . import cache, db, graph, middleware  # noqa: F401
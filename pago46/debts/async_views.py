@@ -0,0 +1,148 @@
+# encoding: utf-8
+"""Async views of debts app
+
+The ORM of Django is synchronous, so the queries run in a bounded pool of
+threads while the event loop serves other requests. The user objects of the
+chunks of a response are created concurrently in the pool.
+"""
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponse, JsonResponse
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import SUMMARY_BATCH_SIZE, User
+from .views import UsernameCursorPagination, add_user, cached_user_objects, create_iou
+
+executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, "DEBTS_ASYNC_THREADS", 8),
+    thread_name_prefix="debts-async",
+)
+
+
+def run_with_connection(function, *args):
+    """Run the function closing the connection of the thread when it is obsolete"""
+
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_pool(function, *args):
+    """Run the function in the thread pool"""
+
+    return await sync_to_async(
+        partial(run_with_connection, function, *args),
+        thread_sensitive=False,
+        executor=executor,
+    )()
+
+
+def json_response(data):
+    """Return the data as the JSON of the synchronous views"""
+
+    if data is None:
+        return HttpResponse()
+    return JsonResponse(data, encoder=JSONEncoder, safe=False)
+
+
+async def concurrent_user_objects(users):
+    """Return the user objects of the users, creating their chunks concurrently"""
+
+    chunks = [
+        users[i : i + SUMMARY_BATCH_SIZE]
+        for i in range(0, len(users), SUMMARY_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(
+        *(run_in_pool(cached_user_objects, chunk) for chunk in chunks)
+    )
+    return [user_object for result in results for user_object in result]
+
+
+def request_data(request):
+    """Return the JSON or the form data of the request as a dict"""
+
+    if request.content_type == "application/json":
+        try:
+            return json.loads(request.body or b"{}")
+        except ValueError:
+            raise ValidationError("Invalid JSON")
+    return request.POST.dict()
+
+
+def api_view(view):
+    """Return the errors of the data of the view as a 400 response
+
+    The view is exempt of the CSRF check like the views of the api.
+    """
+
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        except ValidationError as e:
+            return JsonResponse({"detail": e.detail}, status=400, encoder=JSONEncoder)
+
+    wrapper.csrf_exempt = True
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+@api_view
+async def settleup(request):
+    """Return a list of user objects"""
+
+    if request.method != "GET":
+        return HttpResponse(status=405)
+
+    users_names = request.GET.get("users")
+
+    # Without user names the response is a page, like in the synchronous view
+    if not users_names:
+        paginator = UsernameCursorPagination()
+        page = await run_in_pool(
+            paginator.paginate_queryset, User.objects.all(), Request(request)
+        )
+        user_objects = await concurrent_user_objects(page)
+        return json_response(paginator.get_paginated_response(user_objects).data)
+
+    user_names_list = list(map(str.strip, users_names.split(",")))
+    users = User.objects.filter(username__in=user_names_list).order_by("username")
+    users = await run_in_pool(list, users)
+    return json_response(await concurrent_user_objects(users))
+
+
+@api_view
+async def add(request):
+    """Create a new user"""
+
+    if request.method != "POST":
+        return HttpResponse(status=405)
+
+    return json_response(await run_in_pool(add_user, request_data(request)))
+
+
+@api_view
+async def iou(request):
+    """Create a new debt"""
+
+    if request.method != "POST":
+        return HttpResponse(status=405)
+
+    return json_response(
+        await run_in_pool(
+            create_iou, request_data(request), request.headers.get("Idempotency-Key")
+        )
+    )
@@ -0,0 +1,125 @@
+# encoding: utf-8
+"""Cache of the user objects by user id
+
+Every user has a version in the cache, which is changed when the accumulated
+debts of the user change, once in the transaction and again after the commit.
+The user objects are saved with the version read before they were created, and
+they are only returned while it is the version of the user, so a user object
+created from the rows before a commit is never returned after it, even if it is
+saved after the commit.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.dispatch import receiver
+
+from .signals import accumulate_changed
+
+KEY_PREFIX = "debts:user"
+
+# The keys include a generation, changing it invalidates all the entries
+GENERATION_KEY = f"{KEY_PREFIX}:generation"
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the cache of the DEBTS_CACHE_ALIAS setting"""
+
+    return caches[getattr(settings, "DEBTS_CACHE_ALIAS", "default")]
+
+
+def get_keys(cache, user_ids):
+    """Return the keys of the users by id"""
+
+    generation = cache.get_or_set(GENERATION_KEY, time.time_ns(), timeout=None)
+    return {user_id: f"{KEY_PREFIX}:{generation}:{user_id}" for user_id in user_ids}
+
+
+def get_versions(cache, version_keys):
+    """Return the versions of the users by id, adding the missing ones"""
+
+    versions = cache.get_many(version_keys.values())
+    missing = [key for key in version_keys.values() if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, time.time_ns(), timeout=None)
+        versions.update(cache.get_many(missing))
+    return {user_id: versions.get(key) for user_id, key in version_keys.items()}
+
+
+def get_user_objects(user_ids):
+    """Return the cached user objects of the users by id and the versions of the
+    users, which are saved with the user objects that are created"""
+
+    cache = get_cache()
+    keys = get_keys(cache, user_ids)
+    versions = get_versions(
+        cache, {user_id: f"{key}:version" for user_id, key in keys.items()}
+    )
+    cached = cache.get_many(keys.values())
+    user_objects = {}
+    for user_id, key in keys.items():
+        version, user_object = cached.get(key, (None, None))
+        if version is not None and version == versions[user_id]:
+            user_objects[user_id] = user_object
+    with _stats_lock:
+        _stats["hits"] += len(user_objects)
+        _stats["misses"] += len(keys) - len(user_objects)
+    return user_objects, versions
+
+
+def set_user_objects(user_objects, versions):
+    """Save the user objects of a dict by user id with the versions of the users
+    read before they were created"""
+
+    cache = get_cache()
+    keys = get_keys(cache, user_objects)
+    cache.set_many(
+        {
+            keys[user_id]: (versions[user_id], user_object)
+            for user_id, user_object in user_objects.items()
+            if versions.get(user_id) is not None
+        },
+        timeout=getattr(settings, "DEBTS_CACHE_TIMEOUT", 300),
+    )
+
+
+def invalidate(user_ids=None):
+    """Change the versions of the users, or of all of them if user_ids is None"""
+
+    cache = get_cache()
+    if user_ids is None:
+        cache.set(GENERATION_KEY, time.time_ns(), timeout=None)
+    else:
+        keys = get_keys(cache, user_ids)
+        version = time.time_ns()
+        cache.set_many(
+            {f"{key}:version": version for key in keys.values()}, timeout=None
+        )
+        cache.delete_many(keys.values())
+
+
+def stats():
+    """Return the number of hits and misses of the cache in this process"""
+
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    """Set the hits and misses to zero"""
+
+    with _stats_lock:
+        _stats.update(hits=0, misses=0)
+
+
+@receiver(accumulate_changed)
+def invalidate_changed_users(sender, pairs, **kwargs):
+    """Delete the user objects of the users of the changed pairs after the commit"""
+
+    invalidate(None if pairs is None else {user for pair in pairs for user in pair})
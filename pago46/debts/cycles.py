@@ -0,0 +1,81 @@
+# encoding: utf-8
+"""Cancellation of the cycles of debts
+
+In a cycle of debts, like A owes B, B owes C and C owes A, every debt can be
+reduced by the smallest of them without changing any balance. The cycles are
+searched in a graph of all the accumulated debts, only inside its strongly
+connected components, and cancelled in the database in batches of cycles, one
+transaction per batch.
+"""
+
+from .graph import DebtGraph
+from .models import CENT, AccumulateDelta, CycleCancellation, run_with_retries
+
+# Number of cycles cancelled per transaction
+CYCLE_BATCH_SIZE = 100
+
+
+def find_cycles(debts, limit=None):
+    """Yield the (user ids, cents) of cycles of a graph, cancelling them in it
+
+    Every cycle is the shortest one through a node of a strongly connected
+    component, and its debts are reduced in the graph before searching the next
+    one, so the cycles can be cancelled one after another.
+    """
+
+    found = 0
+    for component in debts.strongly_connected_components():
+        allowed = set(component)
+        for start in sorted(component, key=debts.ids.__getitem__):
+            while limit is None or found < limit:
+                cycle = debts.shortest_cycle(start, allowed)
+                if cycle is None:
+                    break
+                edges = list(zip(cycle, cycle[1:] + cycle[:1]))
+                cents = min(debts.amount(*edge) for edge in edges)
+                for debtor, creditor in edges:
+                    debts.reduce_debt(debtor, creditor, cents)
+                found += 1
+                yield debts.user_ids(cycle), cents
+
+
+def cancel_cycles(batch_size=CYCLE_BATCH_SIZE, limit=None, dry_run=False):
+    """Cancel the cycles of the accumulated debts
+
+    At most limit cycles are cancelled, in transactions of batch_size cycles. The
+    debts could change while the cycles are searched, so every cycle is cancelled
+    by at most the smallest of its current debts. Returns the number of cancelled
+    cycles and the total amount of the cancelled debts.
+    """
+
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1")
+
+    # The cycles are searched in the accumulated debts with all the debts
+    AccumulateDelta.fold()
+    cancelled = 0
+    total = 0
+
+    def cancel(batch):
+        nonlocal cancelled, total
+        if dry_run:
+            cancellations = batch
+        else:
+            cancellations = run_with_retries(
+                lambda: [
+                    (cancellation.users, cancellation.amount)
+                    for cancellation in CycleCancellation.record(batch)
+                ]
+            )
+        cancelled += len(cancellations)
+        total += sum(len(users) * amount for users, amount in cancellations)
+
+    batch = []
+    for users, cents in find_cycles(DebtGraph.load(), limit):
+        batch.append((users, cents * CENT))
+        if len(batch) == batch_size:
+            cancel(batch)
+            batch = []
+    if batch:
+        cancel(batch)
+    return cancelled, total
@@ -0,0 +1,95 @@
+# encoding: utf-8
+"""Database routing and tuning of the connections
+
+The ReplicaRouter sends the reads of the views decorated with read_from_replica
+to the replica database, when there is one, and every write to the primary
+database. The replica is copied from the primary outside of the app, so it can
+be behind it, and the views that write never read from it. What is read from it
+isn't kept in the state shared by the requests, like the cache of the user
+objects and the graph of debts, which read from the primary in primary_reads.
+
+The PRAGMAs of the DEBTS_SQLITE_PRAGMAS setting are set on every new SQLite
+connection.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+REPLICA = "replica"
+
+_reading_from_replica = ContextVar("reading_from_replica", default=False)
+
+
+@contextmanager
+def replica_reads(replica=True):
+    """Send the reads of the block to the replica, or to the primary with False"""
+
+    token = _reading_from_replica.set(replica)
+    try:
+        yield
+    finally:
+        _reading_from_replica.reset(token)
+
+
+def primary_reads():
+    """Send the reads of the block to the primary, also inside a replica block"""
+
+    return replica_reads(False)
+
+
+def reading_from_replica():
+    """Return True if the reads go to the replica"""
+
+    return _reading_from_replica.get() and REPLICA in connections.settings
+
+
+def read_from_replica(view):
+    """Decorate a view so its reads, and the reads of its stream, use the replica"""
+
+    def stream(content):
+        with replica_reads():
+            yield from content
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads():
+            response = view(request, *args, **kwargs)
+        if response.streaming:
+            response.streaming_content = stream(response.streaming_content)
+        return response
+
+    return wrapper
+
+
+class ReplicaRouter:
+    """Route the reads of the replica blocks to the replica and the writes to the
+    primary"""
+
+    def db_for_read(self, model, **hints):
+        if reading_from_replica():
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica has the same rows as the primary
+        return True
+
+
+@receiver(connection_created)
+def set_pragmas(sender, connection, **kwargs):
+    """Set the PRAGMAs of the settings on a new SQLite connection"""
+
+    pragmas = getattr(settings, "DEBTS_SQLITE_PRAGMAS", None)
+    if connection.vendor == "sqlite" and pragmas:
+        with connection.cursor() as cursor:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
@@ -0,0 +1,94 @@
+# encoding: utf-8
+"""Processing of the debts as they expire
+
+A consumer, with a name, walks the expired debts in order and saves in an
+ExpirationWatermark how far it got, so every run only reads the debts that
+expired after the previous one. The debts_expired signal is sent for every batch
+of debts before the watermark is saved, so a batch whose receivers fail is sent
+again in the next run.
+
+The debts expire in the order of their expiration dates, except the debts created
+already expired, which expire when they are created. The debts are processed
+EXPIRATION_DELAY after they expire, when the debts created by then are committed,
+so a debt is never created behind the watermark. The debts created already expired
+before the start of the consumer, like the historical debts of import_debts, are
+never sent.
+"""
+
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import SNAPSHOT_DELAY, Debt, ExpirationWatermark
+from .signals import debts_expired
+
+# Number of debts read and sent at once
+EXPIRATION_BATCH_SIZE = 500
+
+# Time after the expiration of a debt when it is processed
+EXPIRATION_DELAY = SNAPSHOT_DELAY
+
+
+def walk(watermark, debts, field, id_field, end, batch_size):
+    """Send the debts of a queryset after the position of the watermark in an order
+
+    The debts are ordered by the field and id, until the field reaches end, and
+    the position of the last sent debt is saved in the field and the id_field of
+    the watermark. Returns the number of sent debts.
+    """
+
+    sent = 0
+    while True:
+        value, id = getattr(watermark, field), getattr(watermark, id_field)
+        batch = list(
+            debts.filter(
+                Q(**{f"{field}__gt": value}) | Q(**{field: value, "id__gt": id}),
+                **{f"{field}__lte": end},
+            )
+            .select_related("lender", "borrower")
+            .order_by(field, "id")[:batch_size]
+        )
+        if not batch:
+            return sent
+
+        debts_expired.send(sender=Debt, debts=batch, name=watermark.name)
+        setattr(watermark, field, getattr(batch[-1], field))
+        setattr(watermark, id_field, batch[-1].id)
+        watermark.save(update_fields=[field, id_field, "updated_at"])
+        sent += len(batch)
+        if len(batch) < batch_size:
+            return sent
+
+
+def process_expired(
+    name="default", batch_size=EXPIRATION_BATCH_SIZE, now=None, since=None
+):
+    """Send the debts that expired after the previous run of the consumer
+
+    The first run of a consumer starts at since, by default at the end of the run,
+    so the debts that expired before aren't sent, even if they are created later.
+    With since the watermark of an existing consumer is moved to it. Returns the
+    number of sent debts.
+    """
+
+    end = (now or timezone.now()) - EXPIRATION_DELAY
+    start = end if since is None else since
+    watermark, created = ExpirationWatermark.objects.get_or_create(
+        name=name,
+        defaults={"started_at": start, "expiration_date": start, "created_at": start},
+    )
+    if since is not None and not created:
+        watermark.started_at = since
+        watermark.expiration_date = watermark.created_at = since
+        watermark.expiration_debt_id = watermark.created_debt_id = 0
+        watermark.save()
+
+    expired = Debt.objects.filter(expiration_date__gt=F("created_at"))
+    created_expired = Debt.objects.filter(
+        expiration_date__lte=F("created_at"),
+        expiration_date__gt=watermark.started_at,
+    )
+    return walk(
+        watermark, expired, "expiration_date", "expiration_debt_id", end, batch_size
+    ) + walk(
+        watermark, created_expired, "created_at", "created_debt_id", end, batch_size
+    )
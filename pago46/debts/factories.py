@@ -0,0 +1,40 @@
+# encoding: utf-8
+"""Factories of the models of the debts app"""
+
+from datetime import timedelta
+
+import factory
+from factory import fuzzy
+
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+
+from .models import Debt, User
+
+
+class UserFactory(factory.django.DjangoModelFactory):
+    """Factory of users without a usable password"""
+
+    class Meta:
+        model = User
+        django_get_or_create = ("username",)
+
+    username = factory.Sequence(lambda n: f"user{n}")
+    password = factory.LazyFunction(lambda: make_password(None))
+
+
+class DebtFactory(factory.django.DjangoModelFactory):
+    """Factory of debts between two different users
+
+    The debts are created with Debt.save, so they update the accumulated debts.
+    """
+
+    class Meta:
+        model = Debt
+
+    lender = factory.SubFactory(UserFactory)
+    borrower = factory.SubFactory(UserFactory)
+    amount = fuzzy.FuzzyDecimal(1, 500)
+    expiration_date = fuzzy.FuzzyDateTime(
+        timezone.now() - timedelta(days=365), timezone.now() + timedelta(days=365)
+    )
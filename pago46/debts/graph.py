@@ -0,0 +1,346 @@
+# encoding: utf-8
+"""In-memory index of the graph of debts
+
+Every user with debts is a node with a dense index, and every accumulated
+debt is an edge from the debtor to the creditor. The edges of a node are kept
+in arrays of node indexes, with the amounts in cents in parallel arrays.
+
+The index of the process is loaded from DebtAccumulate on first use. The pairs
+changed by the commits of the process are read again on the next use, and the
+whole index is loaded again after DEBTS_GRAPH_MAX_AGE seconds, which bounds how
+old the changes of other processes can be.
+"""
+
+import threading
+import time
+from array import array
+from collections import deque
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from .db import primary_reads
+from .models import SUMMARY_BATCH_SIZE, DebtAccumulate
+from .signals import accumulate_changed
+
+# Number of changed pairs from which the whole index is loaded again
+RELOAD_PAIRS = 10000
+
+
+def to_cents(amount):
+    """Return a Decimal amount as cents"""
+
+    return int(amount * 100)
+
+
+class DebtGraph:
+    """Adjacency index of the debts between users"""
+
+    def __init__(self):
+        self.index = {}
+        self.ids = array("q")
+        # The creditors of every node and what the node owes them, and its debtors
+        self.creditors = []
+        self.amounts = []
+        self.debtors = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def node(self, user_id):
+        """Return the index of the node of a user, adding it if it's missing"""
+
+        node = self.index.get(user_id)
+        if node is None:
+            node = self.index[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.creditors.append(array("l"))
+            self.amounts.append(array("q"))
+            self.debtors.append(array("l"))
+        return node
+
+    def edges(self):
+        """Yield the (debtor id, creditor id, cents) of every debt"""
+
+        for node, creditors in enumerate(self.creditors):
+            for creditor, cents in zip(creditors, self.amounts[node]):
+                yield self.ids[node], self.ids[creditor], cents
+
+    def remove_debt(self, debtor, creditor):
+        """Remove the debt between two nodes, if there is one"""
+
+        creditors = self.creditors[debtor]
+        for position, node in enumerate(creditors):
+            if node == creditor:
+                del creditors[position]
+                del self.amounts[debtor][position]
+                self.debtors[creditor].remove(debtor)
+                return
+
+    def reduce_debt(self, debtor, creditor, cents):
+        """Subtract cents from the debt between two nodes, removing it at zero"""
+
+        position = self.creditors[debtor].index(creditor)
+        self.amounts[debtor][position] -= cents
+        if self.amounts[debtor][position] <= 0:
+            self.remove_debt(debtor, creditor)
+
+    def set_pair(self, user_id, other_id, cents):
+        """Set the net debt between two users, positive if the user owes the other"""
+
+        first, second = self.node(user_id), self.node(other_id)
+        self.remove_debt(first, second)
+        self.remove_debt(second, first)
+        if cents < 0:
+            first, second, cents = second, first, -cents
+        if cents:
+            self.creditors[first].append(second)
+            self.amounts[first].append(cents)
+            self.debtors[second].append(first)
+
+    def add_row(self, lender_id, borrower_id, total_amount):
+        """Add the debt of a DebtAccumulate row"""
+
+        self.set_pair(borrower_id, lender_id, to_cents(total_amount))
+
+    @classmethod
+    def load(cls):
+        """Return the graph of all the accumulated debts"""
+
+        graph = cls()
+        rows = DebtAccumulate.objects.order_by().values_list(
+            "lender_id", "borrower_id", "total_amount"
+        )
+        for row in rows.iterator():
+            graph.add_row(*row)
+        return graph
+
+    def update(self, pairs):
+        """Read again the debts of the (lower id, higher id) pairs"""
+
+        pairs = sorted(pairs)
+        for i in range(0, len(pairs), SUMMARY_BATCH_SIZE):
+            batch = pairs[i : i + SUMMARY_BATCH_SIZE]
+            rows = DebtAccumulate.objects.filter(
+                lender_id__in={low for low, _ in batch},
+                borrower_id__in={high for _, high in batch},
+            ).values_list("lender_id", "borrower_id", "total_amount")
+            totals = {(lender, borrower): total for lender, borrower, total in rows}
+            for low, high in batch:
+                total = totals.get((low, high), 0)
+                if total or (low in self.index and high in self.index):
+                    self.add_row(low, high, total)
+
+    def user_ids(self, nodes):
+        """Return the user ids of the nodes"""
+
+        return [self.ids[node] for node in nodes]
+
+    def neighbourhood(self, user_id, hops):
+        """Return the users at most hops debts away from the user by distance
+
+        The debts are followed in both directions, the user is not included.
+        """
+
+        start = self.index.get(user_id)
+        if start is None:
+            return {}
+        distances = {start: 0}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            distance = distances[node] + 1
+            if distance > hops:
+                continue
+            for neighbours in (self.creditors[node], self.debtors[node]):
+                for neighbour in neighbours:
+                    if neighbour not in distances:
+                        distances[neighbour] = distance
+                        queue.append(neighbour)
+        del distances[start]
+        return {self.ids[node]: distance for node, distance in distances.items()}
+
+    def components(self):
+        """Return the lists of user ids of the connected components, largest first"""
+
+        seen = bytearray(len(self.ids))
+        components = []
+        for start in range(len(self.ids)):
+            if seen[start] or not (self.creditors[start] or self.debtors[start]):
+                continue
+            seen[start] = 1
+            component = [start]
+            for node in component:
+                for neighbours in (self.creditors[node], self.debtors[node]):
+                    for neighbour in neighbours:
+                        if not seen[neighbour]:
+                            seen[neighbour] = 1
+                            component.append(neighbour)
+            components.append(self.user_ids(component))
+        components.sort(key=len, reverse=True)
+        return components
+
+    def strongly_connected_components(self):
+        """Return the lists of nodes of the strongly connected components
+
+        The components of one node are not included, they aren't in any cycle.
+        It is Tarjan's algorithm without recursion.
+        """
+
+        size = len(self.ids)
+        order = array("l", [-1]) * size
+        low = array("l", [0]) * size
+        on_stack = bytearray(size)
+        stack = []
+        components = []
+        counter = 0
+        for root in range(size):
+            if order[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, position = work.pop()
+                if position == 0:
+                    order[node] = low[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = 1
+                creditors = self.creditors[node]
+                while position < len(creditors):
+                    creditor = creditors[position]
+                    position += 1
+                    if order[creditor] == -1:
+                        work.append((node, position))
+                        work.append((creditor, 0))
+                        break
+                    if on_stack[creditor]:
+                        low[node] = min(low[node], order[creditor])
+                else:
+                    if low[node] == order[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = 0
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1:
+                            components.append(component)
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+        return components
+
+    def shortest_cycle(self, start, allowed=None):
+        """Return the nodes of the shortest cycle of debts through a node, or None
+
+        With allowed, a set of nodes, only the debts between them are followed.
+        """
+
+        parents = {start: None}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            for creditor in self.creditors[node]:
+                if allowed is not None and creditor not in allowed:
+                    continue
+                if creditor == start:
+                    cycle = [node]
+                    while parents[cycle[-1]] is not None:
+                        cycle.append(parents[cycle[-1]])
+                    cycle.reverse()
+                    return cycle
+                if creditor not in parents:
+                    parents[creditor] = node
+                    queue.append(creditor)
+        return None
+
+    def amount(self, debtor, creditor):
+        """Return the cents the debtor node owes the creditor node"""
+
+        return self.amounts[debtor][self.creditors[debtor].index(creditor)]
+
+    def cycles(self, user_id=None):
+        """Yield cycles of debts as lists of (debtor id, creditor id, cents)
+
+        Every debt of a cycle can be reduced by the smallest amount of the cycle
+        without changing the balances. With a user it yields the shortest cycle
+        through the user, if any, and without it one cycle of every strongly
+        connected component.
+        """
+
+        if user_id is not None:
+            starts = [(self.index[user_id], None)] if user_id in self.index else []
+        else:
+            starts = [
+                (min(component, key=self.ids.__getitem__), set(component))
+                for component in self.strongly_connected_components()
+            ]
+        for start, allowed in starts:
+            cycle = self.shortest_cycle(start, allowed)
+            if cycle:
+                debts = []
+                for debtor, creditor in zip(cycle, cycle[1:] + cycle[:1]):
+                    cents = self.amount(debtor, creditor)
+                    debts.append((self.ids[debtor], self.ids[creditor], cents))
+                yield debts
+
+
+_graph = None
+_loaded_at = 0.0
+_pending = set()
+_lock = threading.RLock()
+
+
+def current():
+    """Return the graph of the process with the changed pairs read again
+
+    It must be called with the lock, which is held while the graph is used. The
+    graph is read from the primary database, a replica can be behind the changes.
+    """
+
+    global _graph, _loaded_at
+
+    max_age = getattr(settings, "DEBTS_GRAPH_MAX_AGE", 60)
+    expired = time.monotonic() - _loaded_at > max_age
+    with primary_reads():
+        if _graph is None or expired or len(_pending) > RELOAD_PAIRS:
+            _pending.clear()
+            _graph = DebtGraph.load()
+            _loaded_at = time.monotonic()
+        elif _pending:
+            _graph.update(_pending)
+            _pending.clear()
+    return _graph
+
+
+def read(function):
+    """Return the result of the function called with the graph of the process
+
+    The graph is shared by the threads of the process, so they use it one at a
+    time.
+    """
+
+    with _lock:
+        return function(current())
+
+
+def reset():
+    """Discard the graph of the process, it is loaded again on the next use"""
+
+    global _graph
+
+    with _lock:
+        _graph = None
+        _pending.clear()
+
+
+@receiver(accumulate_changed)
+def update_changed_pairs(sender, pairs, **kwargs):
+    """Save the changed pairs to read them again on the next use of the graph"""
+
+    if pairs is None:
+        reset()
+    else:
+        with _lock:
+            _pending.update(pairs)
@@ -0,0 +1,47 @@
+# encoding: utf-8
+"""Command to cancel the cycles of debts"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from debts.cycles import CYCLE_BATCH_SIZE, cancel_cycles
+
+
+class Command(BaseCommand):
+    """Cancel the cycles of the accumulated debts in batches"""
+
+    help = (
+        "Find the cycles of the accumulated debts and reduce their debts by the "
+        "smallest one, without changing the balances"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=CYCLE_BATCH_SIZE,
+            help="Number of cycles cancelled per transaction",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            help="Maximum number of cycles to cancel",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only find the cycles, without cancelling them",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("The batch size must be at least 1")
+
+        cycles, amount = cancel_cycles(
+            batch_size=options["batch_size"],
+            limit=options["limit"],
+            dry_run=options["dry_run"],
+        )
+        action = "Found" if options["dry_run"] else "Cancelled"
+        self.stdout.write(
+            self.style.SUCCESS(f"{action} {cycles} cycles, {amount} in debts")
+        )
@@ -0,0 +1,32 @@
+# encoding: utf-8
+"""Command to verify and rebuild the UserObject rows"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from debts.models import UserObject
+
+
+class Command(BaseCommand):
+    """Verify the user objects of the users against the accumulated debts"""
+
+    help = "Verify the UserObject rows against the accumulated debts"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Rebuild the rows from the accumulated debts before verifying them",
+        )
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            count = UserObject.rebuild()
+            self.stdout.write(f"Rebuilt the user objects of {count} users")
+
+        mismatches = UserObject.verify()
+        if mismatches:
+            raise CommandError(
+                f"{len(mismatches)} user objects differ from the debts, "
+                f"users: {', '.join(map(str, mismatches[:20]))}"
+            )
+        self.stdout.write(self.style.SUCCESS("The user objects match the debts"))
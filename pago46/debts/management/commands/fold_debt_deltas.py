@@ -0,0 +1,41 @@
+# encoding: utf-8
+"""Command to fold the log of debts into the accumulated debts"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from debts.models import SUMMARY_BATCH_SIZE, AccumulateDelta
+
+
+class Command(BaseCommand):
+    """Add the debts of the write-behind log to the accumulated debts"""
+
+    help = (
+        "Add the debts appended to the log in write-behind mode to the accumulated "
+        "debts and the balances, once or every --interval seconds"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=SUMMARY_BATCH_SIZE,
+            help="Number of debts of the log folded per transaction",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Seconds between runs, without it the command runs once",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("The batch size must be at least 1")
+
+        while True:
+            folded = AccumulateDelta.fold(options["batch_size"])
+            self.stdout.write(self.style.SUCCESS(f"Folded {folded} debts"))
+            if options["interval"] is None:
+                break
+            time.sleep(options["interval"])
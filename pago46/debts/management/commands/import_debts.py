@@ -0,0 +1,191 @@
+# encoding: utf-8
+"""Command to import historical debts from a CSV or NDJSON file"""
+
+import csv
+import json
+import time
+from itertools import islice
+from pathlib import Path
+
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from debts.models import BULK_BATCH_SIZE, Debt, DebtAccumulate, User, UserBalance
+
+
+def read_rows(file, file_format):
+    """Yield the rows of the file as dicts, or None for the lines that aren't JSON"""
+
+    if file_format == "csv":
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+
+def to_entry(row):
+    """Return the entry for Debt.build of a row with the parameters of /iou"""
+
+    if isinstance(row, dict) and "expiration" in row:
+        row = dict(row)
+        row["expiration_date"] = row.pop("expiration")
+    return row
+
+
+def chunks(rows, size):
+    """Yield lists of size rows"""
+
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+
+def get_or_create_users(usernames):
+    """Return a dict by username of the users, creating the missing ones in bulk"""
+
+    users = {
+        user.username: user for user in User.objects.filter(username__in=usernames)
+    }
+    missing = [username for username in usernames if username not in users]
+    if missing:
+        # The users are created without a usable password
+        User.objects.bulk_create(
+            [
+                User(username=username, password=make_password(None))
+                for username in missing
+            ],
+            batch_size=BULK_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        users.update(
+            (user.username, user) for user in User.objects.filter(username__in=missing)
+        )
+    return users
+
+
+class Command(BaseCommand):
+    """Import the debts of a file in chunks and rebuild the accumulated debts"""
+
+    help = (
+        "Import debts from a CSV or NDJSON file with the lender, borrower, amount "
+        "and expiration of every debt"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File with the debts")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "ndjson"],
+            help="Format of the file, by default it is taken from the extension",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Number of debts created per transaction",
+        )
+        parser.add_argument(
+            "--start-at",
+            type=int,
+            help="Number of rows of the file to skip",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help=(
+                "File where the number of processed rows is saved after every "
+                "chunk, the import resumes from it"
+            ),
+        )
+        parser.add_argument(
+            "--no-rebuild",
+            action="store_true",
+            help="Don't rebuild the accumulated debts and the balances at the end",
+        )
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("The chunk size must be at least 1")
+        if options["start_at"] is not None and options["start_at"] < 0:
+            raise CommandError("The number of rows to skip can't be negative")
+
+        path = Path(options["path"])
+        file_format = options["format"] or (
+            "csv" if path.suffix.lower() == ".csv" else "ndjson"
+        )
+        checkpoint = Path(options["checkpoint"]) if options["checkpoint"] else None
+
+        # The offset in the arguments has priority over the checkpoint
+        offset = options["start_at"]
+        if offset is None:
+            offset = 0
+            if checkpoint and checkpoint.exists():
+                offset = int(checkpoint.read_text().strip() or 0)
+        if offset:
+            self.stdout.write(f"Resuming after {offset} rows")
+
+        start = time.monotonic()
+        created = 0
+        invalid = 0
+        try:
+            file = path.open(newline="")
+        except OSError as e:
+            raise CommandError(f"Can't open {path}: {e}")
+
+        with file:
+            rows = islice(read_rows(file, file_format), offset, None)
+            for chunk in chunks(map(to_entry, rows), options["chunk_size"]):
+                usernames = set()
+                for entry in chunk:
+                    if isinstance(entry, dict):
+                        usernames.update(
+                            entry[key]
+                            for key in ("lender", "borrower")
+                            if isinstance(entry.get(key), str) and entry[key]
+                        )
+
+                debts = []
+                with transaction.atomic():
+                    users = get_or_create_users(usernames)
+                    for index, entry in enumerate(chunk, start=offset + 1):
+                        try:
+                            debts.append(Debt.build(entry, users))
+                        except ValidationError as e:
+                            invalid += 1
+                            if options["verbosity"] >= 2:
+                                messages = " ".join(e.messages)
+                                self.stderr.write(f"Row {index}: {messages}")
+                    Debt.objects.bulk_create(debts, batch_size=BULK_BATCH_SIZE)
+
+                offset += len(chunk)
+                created += len(debts)
+                if checkpoint:
+                    checkpoint.write_text(str(offset))
+                elapsed = max(time.monotonic() - start, 1e-9)
+                self.stdout.write(
+                    f"{offset} rows processed, {created} debts created "
+                    f"({created / elapsed:.0f} debts/s)"
+                )
+
+        if not options["no_rebuild"]:
+            pairs = DebtAccumulate.rebuild()
+            balances = UserBalance.rebuild()
+            self.stdout.write(
+                f"Rebuilt the accumulated debts of {pairs} pairs "
+                f"and the balances of {balances} users"
+            )
+
+        elapsed = max(time.monotonic() - start, 1e-9)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {created} debts in {elapsed:.1f}s "
+                f"({created / elapsed:.0f} debts/s), {invalid} invalid rows"
+            )
+        )
@@ -0,0 +1,62 @@
+# encoding: utf-8
+"""Command to process the debts as they expire"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from debts.expiration import EXPIRATION_BATCH_SIZE, process_expired
+
+
+class Command(BaseCommand):
+    """Send the debts that expired after the previous run of a consumer"""
+
+    help = (
+        "Send the debts_expired signal with the debts that expired after the "
+        "previous run, once or every --interval seconds"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--name",
+            default="default",
+            help="Name of the consumer, every consumer has its own watermark",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=EXPIRATION_BATCH_SIZE,
+            help="Number of debts sent at once",
+        )
+        parser.add_argument(
+            "--since",
+            help="ISO time from which the debts are sent, it moves the watermark",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Seconds between runs, without it the command runs once",
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options["since"]:
+            since = parse_datetime(options["since"])
+            if since is None:
+                raise CommandError(f"Invalid time {options['since']}")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+
+        while True:
+            processed = process_expired(
+                name=options["name"], batch_size=options["batch_size"], since=since
+            )
+            self.stdout.write(
+                self.style.SUCCESS(f"Processed {processed} expired debts")
+            )
+            if options["interval"] is None:
+                break
+            since = None
+            time.sleep(options["interval"])
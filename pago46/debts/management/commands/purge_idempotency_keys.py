@@ -0,0 +1,16 @@
+# encoding: utf-8
+"""Command to delete the expired idempotency keys"""
+
+from django.core.management.base import BaseCommand
+
+from debts.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    """Delete the idempotency keys older than DEBTS_IDEMPOTENCY_TIMEOUT"""
+
+    help = "Delete the saved responses of the expired idempotency keys"
+
+    def handle(self, *args, **options):
+        deleted = IdempotencyKey.purge()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired keys"))
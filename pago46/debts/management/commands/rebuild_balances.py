@@ -0,0 +1,32 @@
+# encoding: utf-8
+"""Command to rebuild and verify the UserBalance ledger"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from debts.models import UserBalance
+
+
+class Command(BaseCommand):
+    """Rebuild the balances of the users from the Debt rows and verify them"""
+
+    help = "Rebuild the UserBalance ledger from the Debt rows and verify it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only verify the ledger, without rebuilding it",
+        )
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            count = UserBalance.rebuild()
+            self.stdout.write(f"Rebuilt the balances of {count} users")
+
+        mismatches = UserBalance.verify()
+        if mismatches:
+            raise CommandError(
+                f"{len(mismatches)} balances differ from the debts, "
+                f"users: {', '.join(map(str, mismatches[:20]))}"
+            )
+        self.stdout.write(self.style.SUCCESS("The ledger matches the debts"))
@@ -0,0 +1,55 @@
+# encoding: utf-8
+"""Command to take and compact the snapshots of the balances"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from debts.models import BalanceSnapshot
+
+
+class Command(BaseCommand):
+    """Take a snapshot of the debts of every user and delete the old ones"""
+
+    help = "Take a snapshot of the debts of every user and compact the old snapshots"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--as-of",
+            help="ISO time of the snapshot, by default a minute ago",
+        )
+        parser.add_argument(
+            "--keep",
+            type=int,
+            help=(
+                "Number of newest snapshots to keep, of the older ones only the "
+                "last of every day is kept"
+            ),
+        )
+        parser.add_argument(
+            "--no-snapshot",
+            action="store_true",
+            help="Only compact the snapshots, without taking a new one",
+        )
+
+    def handle(self, *args, **options):
+        if not options["no_snapshot"]:
+            taken_at = None
+            if options["as_of"]:
+                taken_at = parse_datetime(options["as_of"])
+                if taken_at is None:
+                    raise CommandError(f"Invalid time {options['as_of']}")
+                if timezone.is_naive(taken_at):
+                    taken_at = timezone.make_aware(taken_at)
+
+            snapshot = BalanceSnapshot.take(taken_at)
+            self.stdout.write(
+                f"Snapshot of {snapshot.users.count()} users "
+                f"at {snapshot.taken_at.isoformat()}"
+            )
+
+        if options["keep"] is not None:
+            deleted = BalanceSnapshot.compact(options["keep"])
+            self.stdout.write(f"Deleted {deleted} old snapshots")
+
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,207 @@
+# encoding: utf-8
+"""Middleware that measures the queries and the time of every request
+
+The measures are returned in the Server-Timing header and written to the
+debts.timing log as JSON:
+
+- db: the number of queries and their time, the slowest query is only logged.
+- view: the time of the view, with the queries.
+- render: the time to render the response after the view.
+- total: the wall time of the request in the middleware.
+
+With the DEBTS_PROFILE_THRESHOLD_MS setting every request is profiled and the
+profile of the requests slower than the threshold is saved to DEBTS_PROFILE_DIR.
+
+The queries are recorded by an execute wrapper of every connection in the
+recorder of the request in a context variable, which is copied to the threads
+where the async views run their queries, so they are measured under ASGI too.
+Under ASGI the middleware is async, so the requests are handled concurrently.
+They share the thread of the event loop, so they aren't profiled and a warning
+is logged if DEBTS_PROFILE_THRESHOLD_MS is set.
+"""
+
+import asyncio
+import cProfile
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger("debts.timing")
+
+# Characters of the slowest query that are logged
+SQL_MAX_LENGTH = 1000
+
+
+class QueryRecorder:
+    """Execute wrapper that counts the queries and their time
+
+    The queries of an async view can run in several threads at once.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = None
+        self.slowest_duration = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.count += 1
+                self.duration += duration
+                if self.slowest is None or duration > self.slowest_duration:
+                    self.slowest = sql
+                    self.slowest_duration = duration
+
+
+# Recorder of the queries of the current request
+_recorder = ContextVar("timing_recorder", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute a query, recording it in the recorder of the request if there is one"""
+
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def add_query_recorder(sender, connection, **kwargs):
+    """Record the queries of a new connection in the recorder of the request"""
+
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class TimingMiddleware:
+    """Measure the queries and the time of the view and the rendering"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Mark the instance as a coroutine function, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            if getattr(settings, "DEBTS_PROFILE_THRESHOLD_MS", None) is not None:
+                logger.warning(
+                    "DEBTS_PROFILE_THRESHOLD_MS is ignored, the requests under ASGI "
+                    "aren't profiled"
+                )
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        threshold = getattr(settings, "DEBTS_PROFILE_THRESHOLD_MS", None)
+        profiler = cProfile.Profile() if threshold is not None else None
+        recorder = QueryRecorder()
+        request._timing_view_end = None
+
+        token = _recorder.set(recorder)
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            if profiler:
+                profiler.disable()
+            _recorder.reset(token)
+        end = time.perf_counter()
+
+        timing = self.timing(request, response, recorder, start, end)
+        if profiler and timing["total_ms"] >= threshold:
+            timing["profile"] = self.save_profile(profiler, timing)
+        return self.log(response, timing)
+
+    async def __acall__(self, request):
+        """Measure an async request, without blocking the others"""
+
+        recorder = QueryRecorder()
+        request._timing_view_end = None
+        token = _recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _recorder.reset(token)
+        end = time.perf_counter()
+
+        timing = self.timing(request, response, recorder, start, end)
+        return self.log(response, timing)
+
+    def timing(self, request, response, recorder, start, end):
+        """Return the measures of a request"""
+
+        # The responses of the views of the api are rendered after the view
+        view_end = request._timing_view_end or end
+        return {
+            "method": request.method,
+            "path": request.path,
+            "view": self.view_name(request),
+            "status": response.status_code,
+            "queries": recorder.count,
+            "db_ms": round(recorder.duration * 1000, 3),
+            "view_ms": round((view_end - start) * 1000, 3),
+            "render_ms": round((end - view_end) * 1000, 3),
+            "total_ms": round((end - start) * 1000, 3),
+            "slowest_sql_ms": round(recorder.slowest_duration * 1000, 3),
+            "slowest_sql": (recorder.slowest or "")[:SQL_MAX_LENGTH] or None,
+        }
+
+    @staticmethod
+    def log(response, timing):
+        """Add the Server-Timing header to the response and log the measures"""
+
+        response["Server-Timing"] = ", ".join(
+            [
+                f'db;dur={timing["db_ms"]};desc="{timing["queries"]} queries"',
+                f'view;dur={timing["view_ms"]}',
+                f'render;dur={timing["render_ms"]}',
+                f'total;dur={timing["total_ms"]}',
+            ]
+        )
+        logger.info(json.dumps(timing), extra={"timing": timing})
+        return response
+
+    def process_template_response(self, request, response):
+        """Save the end of the view, before the response is rendered"""
+
+        request._timing_view_end = time.perf_counter()
+        return response
+
+    @staticmethod
+    def view_name(request):
+        """Return the name of the url of the view, or the path without one"""
+
+        match = getattr(request, "resolver_match", None)
+        if match is None:
+            return None
+        return match.view_name or match._func_path
+
+    @staticmethod
+    def save_profile(profiler, timing):
+        """Save the profile of a slow request and return the path of the file"""
+
+        directory = Path(getattr(settings, "DEBTS_PROFILE_DIR", "profiles"))
+        directory.mkdir(parents=True, exist_ok=True)
+        name = (timing["view"] or "unknown").replace("/", "_").replace(".", "_")
+        path = directory / f"{time.time_ns()}-{name}-{timing['total_ms']:.0f}ms.prof"
+        profiler.dump_stats(path)
+        return str(path)
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.16 on 2026-10-18 07:42
+
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def populate_balances(apps, schema_editor):
+    """Fill the ledger with the balances of the existing debts"""
+
+    Debt = apps.get_model("debts", "Debt")
+    UserBalance = apps.get_model("debts", "UserBalance")
+
+    balances = {}
+    totals = Debt.objects.order_by().values("lender_id").annotate(total=Sum("amount"))
+    for item in totals:
+        balances[item["lender_id"]] = UserBalance(
+            user_id=item["lender_id"], credit_total=item["total"], debit_total=0
+        )
+    totals = Debt.objects.order_by().values("borrower_id").annotate(total=Sum("amount"))
+    for item in totals:
+        balance = balances.setdefault(
+            item["borrower_id"],
+            UserBalance(user_id=item["borrower_id"], credit_total=0),
+        )
+        balance.debit_total = item["total"]
+    for balance in balances.values():
+        balance.net = balance.credit_total - balance.debit_total
+    UserBalance.objects.bulk_create(balances.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('debts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBalance',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to='auth.user')),
+                ('credit_total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('debit_total', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('net', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+        ),
+        migrations.RunPython(populate_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.16 on 2026-10-18 07:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debts', '0002_userbalance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='debt',
+            index=models.Index(fields=['expiration_date', 'id'], name='debt_expiration_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='debt',
+            index=models.Index(fields=['lender', 'expiration_date'], name='debt_lender_expiration_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='debt',
+            index=models.Index(fields=['borrower', 'expiration_date'], name='debt_borrower_expiration_idx'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.2.16 on 2026-10-18 08:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('debts', '0003_debt_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(unique=True)),
+            ],
+            options={
+                'ordering': ['-taken_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owes', models.JSONField(default=dict)),
+                ('owed_by', models.JSONField(default=dict)),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='debt',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='debt',
+            index=models.Index(fields=['created_at'], name='debt_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='usersnapshot',
+            name='snapshot',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='users', to='debts.balancesnapshot'),
+        ),
+        migrations.AddField(
+            model_name='usersnapshot',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='usersnapshot',
+            unique_together={('snapshot', 'user')},
+        ),
+    ]
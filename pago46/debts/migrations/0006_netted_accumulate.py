@@ -0,0 +1,63 @@
+# Generated by Django 3.2.16 on 2026-10-18 08:14
+
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+def net_pairs(apps, schema_editor):
+    """Replace the two rows of every pair with one row of the net debt
+
+    The lender of the row is the user with the lower id and a negative total is
+    a debt of the lender to the borrower.
+    """
+
+    DebtAccumulate = apps.get_model("debts", "DebtAccumulate")
+
+    totals = {}
+    rows = DebtAccumulate.objects.values_list("lender_id", "borrower_id", "total_amount")
+    for lender_id, borrower_id, total in rows.iterator():
+        if lender_id < borrower_id:
+            pair = (lender_id, borrower_id)
+        else:
+            pair, total = (borrower_id, lender_id), -total
+        totals[pair] = totals.get(pair, Decimal(0)) + total
+
+    DebtAccumulate.objects.all().delete()
+    DebtAccumulate.objects.bulk_create(
+        (
+            DebtAccumulate(
+                lender_id=lender_id, borrower_id=borrower_id, total_amount=total
+            )
+            for (lender_id, borrower_id), total in totals.items()
+            if total
+        ),
+        batch_size=500,
+    )
+
+
+def split_pairs(apps, schema_editor):
+    """Turn the negative rows into positive rows of the other direction"""
+
+    DebtAccumulate = apps.get_model("debts", "DebtAccumulate")
+
+    for row in DebtAccumulate.objects.filter(total_amount__lt=0).iterator():
+        row.lender_id, row.borrower_id = row.borrower_id, row.lender_id
+        row.total_amount = -row.total_amount
+        row.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debts', '0005_payments'),
+    ]
+
+    operations = [
+        migrations.RunPython(net_pairs, split_pairs),
+        migrations.AddConstraint(
+            model_name='debtaccumulate',
+            constraint=models.CheckConstraint(check=models.Q(('lender__lt', django.db.models.expressions.F('borrower'))), name='debt_accumulate_pair_order'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.16 on 2026-10-18 08:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debts', '0006_netted_accumulate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CycleCancellation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('users', models.JSONField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='cancellation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='payments', to='debts.cyclecancellation'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.16 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debts', '0007_cycle_cancellations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpirationWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('expiration_date', models.DateTimeField()),
+                ('expiration_debt_id', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField()),
+                ('created_debt_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
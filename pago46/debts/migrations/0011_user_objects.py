@@ -0,0 +1,24 @@
+# Generated by Django 3.2.16 on 2026-10-18 08:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('debts', '0010_accumulate_deltas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserObject',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='user_object', serialize=False, to='auth.user')),
+                ('owes', models.JSONField(default=dict)),
+                ('owed_by', models.JSONField(default=dict)),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+        ),
+    ]
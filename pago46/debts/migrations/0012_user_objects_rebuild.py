@@ -0,0 +1,62 @@
+# Generated by Django 3.2.16 on 2026-10-18 09:21
+
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def populate_user_objects(apps, schema_editor):
+    """Fill the user objects with the accumulated debts and mark them as complete
+
+    The amounts are in cents by username, a positive total of a pair is a debt of
+    the borrower.
+    """
+
+    DebtAccumulate = apps.get_model("debts", "DebtAccumulate")
+    UserObject = apps.get_model("debts", "UserObject")
+    UserObjectsRebuild = apps.get_model("debts", "UserObjectsRebuild")
+
+    objects = {}
+    rows = DebtAccumulate.objects.values_list(
+        "lender_id",
+        "lender__username",
+        "borrower_id",
+        "borrower__username",
+        "total_amount",
+    )
+    for lender_id, lender, borrower_id, borrower, total in rows.iterator():
+        creditor, debtor = (lender_id, lender), (borrower_id, borrower)
+        cents = int(total * 100)
+        if cents < 0:
+            creditor, debtor, cents = debtor, creditor, -cents
+        for user_id, _ in (creditor, debtor):
+            if user_id not in objects:
+                objects[user_id] = UserObject(user_id=user_id, owes={}, owed_by={})
+        objects[creditor[0]].owed_by[debtor[1]] = cents
+        objects[debtor[0]].owes[creditor[1]] = cents
+    for user_object in objects.values():
+        cents = sum(user_object.owed_by.values()) - sum(user_object.owes.values())
+        user_object.balance = Decimal(cents) / 100
+
+    UserObject.objects.all().delete()
+    UserObject.objects.bulk_create(objects.values(), batch_size=500)
+    UserObjectsRebuild.objects.create()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debts', '0011_user_objects'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserObjectsRebuild',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rebuilt_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(populate_user_objects, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.16 on 2026-10-18 09:26
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debts', '0012_user_objects_rebuild'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expirationwatermark',
+            name='started_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
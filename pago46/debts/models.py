@@ -1,11 +1,114 @@
 # encoding: utf-8
 """Models for debts app"""
 
+import random
+import time
+from collections import defaultdict
+from datetime import timedelta
 from decimal import Decimal
+from itertools import islice
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.core.validators import MinValueValidator
+from django.db import IntegrityError, OperationalError, models, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from . import cache
+from .signals import accumulate_changed
+
+# Number of users per query when summarizing a list of users, it keeps the
+# parameters of the query below the SQLite limit.
+SUMMARY_BATCH_SIZE = 400
+
+# Number of rows inserted per query in the bulk inserts
+BULK_BATCH_SIZE = 500
+
+CENT = Decimal("0.01")
+
+# Age of the default time of a snapshot, the debts created before it are
+# committed by then
+SNAPSHOT_DELAY = timedelta(minutes=1)
+
+# Attempts, and base and maximum delay in seconds, to retry a write that found
+# the rows locked
+WRITE_RETRIES = 30
+WRITE_RETRY_DELAY = 0.005
+WRITE_RETRY_MAX_DELAY = 0.2
+
+
+def increment(model, lookup, deltas):
+    """Add the deltas to the fields of the row of the lookup in the database
+
+    The row is created with the deltas as values if it doesn't exist. The UPDATE
+    locks the row until the end of the transaction, and if another transaction
+    inserts the same row first the increment is applied over it.
+    """
+
+    values = {field: F(field) + delta for field, delta in deltas.items()}
+    if model.objects.filter(**lookup).update(**values):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **deltas)
+    except IntegrityError:
+        model.objects.filter(**lookup).update(**values)
+
+
+def run_with_retries(function):
+    """Run the function in a transaction, retrying it when the database is locked
+
+    Inside an outer transaction there is nothing to retry, so the error is raised.
+    """
+
+    for attempt in range(WRITE_RETRIES):
+        try:
+            with transaction.atomic():
+                return function()
+        except OperationalError:
+            if transaction.get_connection().in_atomic_block:
+                raise
+            if attempt == WRITE_RETRIES - 1:
+                raise
+            delay = min(WRITE_RETRY_DELAY * 2**attempt, WRITE_RETRY_MAX_DELAY)
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+def write_behind():
+    """Return if the debts are added to the accumulated debts later, in batches"""
+
+    return getattr(settings, "DEBTS_WRITE_BEHIND", False)
+
+
+def materialized():
+    """Return if the user objects are kept in UserObject rows"""
+
+    return getattr(settings, "DEBTS_USER_OBJECTS", False)
+
+
+def add_net(totals, lender_id, borrower_id, amount):
+    """Add a debt to a dict of net debts by (lower user id, higher user id)
+
+    A positive net debt is owed to the lower user and a negative one to the higher
+    user. A payment is added as a debt of the payee.
+    """
+
+    if lender_id < borrower_id:
+        totals[(lender_id, borrower_id)] += amount
+    else:
+        totals[(borrower_id, lender_id)] -= amount
+
+
+def directed_debts(totals):
+    """Yield the (lender id, borrower id, amount) of a dict of net debts"""
+
+    for (low_id, high_id), amount in totals.items():
+        if amount > 0:
+            yield low_id, high_id, amount
+        elif amount < 0:
+            yield high_id, low_id, -amount
 
 
 class Debt(models.Model):
@@ -19,9 +122,21 @@ class Debt(models.Model):
     )
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     expiration_date = models.DateTimeField()
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ["-expiration_date"]
+        indexes = [
+            models.Index(fields=["created_at"], name="debt_created_idx"),
+            models.Index(fields=["expiration_date", "id"], name="debt_expiration_idx"),
+            models.Index(
+                fields=["lender", "expiration_date"], name="debt_lender_expiration_idx"
+            ),
+            models.Index(
+                fields=["borrower", "expiration_date"],
+                name="debt_borrower_expiration_idx",
+            ),
+        ]
 
     def clean(self, *args, **kwargs):
         """Apply business rules to the model"""
@@ -34,22 +149,268 @@ class Debt(models.Model):
 
     def save(self, *args, **kwargs):
         """Update the accumulated debt when creating a new debt"""
-        self.full_clean()
-        # If there is an accumulated debt for the pair, obtain it and update the amount,
-        # if not, create a new one.
-        debt_accumulated, created = DebtAccumulate.objects.get_or_create(
-            lender=self.lender,
-            borrower=self.borrower,
-            defaults={"total_amount": self.amount},
-        )
-        if not created:
-            debt_accumulated.total_amount += Decimal(self.amount)
-            debt_accumulated.save()
+        adding = self._state.adding
+
+        def record():
+            self.full_clean()
+            self.insert()
+
+        try:
+            run_with_retries(record)
+        except Exception:
+            # A failed insert must be an insert again in the next save
+            if adding:
+                self.pk = None
+                self._state.adding = True
+            raise
+
+    def insert(self):
+        """Insert the validated debt and add it to the accumulated debts
+
+        It must run in a transaction.
+        """
+
         super(Debt, self).save()
+        DebtAccumulate.add(self.lender_id, self.borrower_id, Decimal(self.amount))
+
+    @classmethod
+    def record(cls, entry):
+        """Create the debt of an entry of bulk_record in one transaction
+
+        Both users are read with one query and the debt is validated with them, so
+        the foreign keys aren't read again. Raises User.DoesNotExist if a user
+        doesn't exist. Returns the debt.
+        """
+
+        def record():
+            usernames = {entry["lender"], entry["borrower"]}
+            users = User.objects.in_bulk(usernames, field_name="username")
+            for key in ("lender", "borrower"):
+                if entry[key] not in users:
+                    raise User.DoesNotExist(f"There is no user {entry[key]}")
+            debt = cls.build(entry, users)
+            debt.insert()
+            return debt
+
+        return run_with_retries(record)
+
+    @classmethod
+    def bulk_record(cls, entries):
+        """Create many debts and update their accumulated debts at once
+
+        Every entry is a dict with the lender and borrower usernames, the amount and
+        the expiration_date. Returns the created debts and a list of (index, errors)
+        of the entries that are not valid, which are skipped.
+        """
+
+        entries = list(entries)
+        usernames = set()
+        for entry in entries:
+            if isinstance(entry, dict):
+                usernames.update(
+                    entry[key]
+                    for key in ("lender", "borrower")
+                    if isinstance(entry.get(key), str)
+                )
+        users = {
+            user.username: user for user in User.objects.filter(username__in=usernames)
+        }
+
+        debts = []
+        errors = []
+        for index, entry in enumerate(entries):
+            try:
+                debts.append(cls.build(entry, users))
+            except ValidationError as e:
+                errors.append((index, e.messages))
+
+        if debts:
+            deltas = {}
+            for debt in debts:
+                pair = (debt.lender_id, debt.borrower_id)
+                deltas[pair] = deltas.get(pair, 0) + debt.amount
+
+            def record():
+                cls.objects.bulk_create(debts, batch_size=BULK_BATCH_SIZE)
+                DebtAccumulate.add_many(deltas)
+
+            run_with_retries(record)
+        return debts, errors
+
+    @classmethod
+    def build(cls, entry, users):
+        """Return a validated debt from an entry of bulk_record
+
+        The users are a dict by username, so the validation doesn't query them again.
+        """
+
+        if not isinstance(entry, dict):
+            raise ValidationError("Invalid debt")
+        missing = [
+            key
+            for key in ("lender", "borrower", "amount", "expiration_date")
+            if key not in entry
+        ]
+        if missing:
+            raise ValidationError(f"There is no {', '.join(missing)} data")
+        for key in ("lender", "borrower"):
+            if not isinstance(entry[key], str):
+                raise ValidationError(f"The {key} must be a username")
+            if entry[key] not in users:
+                raise ValidationError(f"There is no user {entry[key]}")
+
+        debt = cls(
+            lender=users[entry["lender"]],
+            borrower=users[entry["borrower"]],
+            amount=entry["amount"],
+            expiration_date=entry["expiration_date"],
+        )
+        debt.full_clean(exclude=["lender", "borrower"])
+        if settings.USE_TZ and timezone.is_naive(debt.expiration_date):
+            debt.expiration_date = timezone.make_aware(debt.expiration_date)
+        return debt
+
+    @classmethod
+    def expiring(cls, start, end):
+        """Return the debts that expire after start and until end, in that order
+
+        The debts are read from the expiration index, by expiration date and id.
+        """
+
+        return (
+            cls.objects.filter(expiration_date__gt=start, expiration_date__lte=end)
+            .select_related("lender", "borrower")
+            .order_by("expiration_date", "id")
+        )
+
+
+class Payment(models.Model):
+    """Payments from one user to another"""
+
+    payer = models.ForeignKey(
+        User, related_name="payments_made", on_delete=models.CASCADE
+    )
+    payee = models.ForeignKey(
+        User, related_name="payments_received", on_delete=models.CASCADE
+    )
+    amount = models.DecimalField(
+        max_digits=10, decimal_places=2, validators=[MinValueValidator(CENT)]
+    )
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # The cancellation of a cycle of debts that created the payment
+    cancellation = models.ForeignKey(
+        "CycleCancellation",
+        null=True,
+        blank=True,
+        related_name="payments",
+        on_delete=models.PROTECT,
+    )
+
+    def clean(self):
+        """The payer and the payee can't be the same user"""
+
+        if self.payer_id == self.payee_id:
+            raise ValidationError("Payer and payee can't be the same")
+
+    def save(self, *args, **kwargs):
+        """Subtract the payment from the accumulated debts of the pair"""
+        adding = self._state.adding
+
+        def record():
+            self.full_clean()
+            super(Payment, self).save()
+            DebtAccumulate.pay(self.payer_id, self.payee_id, Decimal(self.amount))
+
+        try:
+            run_with_retries(record)
+        except Exception:
+            if adding:
+                self.pk = None
+                self._state.adding = True
+            raise
+
+
+class CycleCancellation(models.Model):
+    """Saves the cancellation of a cycle of debts
+
+    Every user of the cycle pays its debt to the next one the amount of the
+    cancellation, with the payments of the cancellation, so the balances don't
+    change.
+    """
+
+    created_at = models.DateTimeField(default=timezone.now)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # The ids of the users of the cycle, every user owed the next one
+    users = models.JSONField()
+
+    @classmethod
+    def record(cls, cycles):
+        """Cancel the cycles of a list of (user ids, amount) in the database
+
+        The cycles are checked against the accumulated debts, which could have
+        changed, and a cycle is cancelled by the smallest of its current debts. It
+        must run in a transaction. Returns the cancellations.
+        """
+
+        debts = {}
+        for users, _ in cycles:
+            for debtor_id, creditor_id in zip(users, users[1:] + users[:1]):
+                debts[(min(debtor_id, creditor_id), max(debtor_id, creditor_id))] = 0
+        pairs = sorted(debts)
+        for i in range(0, len(pairs), SUMMARY_BATCH_SIZE):
+            batch = pairs[i : i + SUMMARY_BATCH_SIZE]
+            rows = DebtAccumulate.objects.select_for_update().filter(
+                lender_id__in={low for low, _ in batch},
+                borrower_id__in={high for _, high in batch},
+            )
+            for lender_id, borrower_id, total in rows.values_list(
+                "lender_id", "borrower_id", "total_amount"
+            ):
+                if (lender_id, borrower_id) in debts:
+                    debts[(lender_id, borrower_id)] = total
+
+        def owed(debtor_id, creditor_id):
+            """Return what the debtor owes the creditor in the current debts"""
+
+            if debtor_id > creditor_id:
+                return debts[(creditor_id, debtor_id)]
+            return -debts[(debtor_id, creditor_id)]
+
+        cancellations = []
+        payments = []
+        deltas = defaultdict(Decimal)
+        for users, amount in cycles:
+            edges = list(zip(users, users[1:] + users[:1]))
+            amount = min([amount] + [owed(*edge) for edge in edges])
+            if amount <= 0:
+                continue
+            cancellation = cls.objects.create(amount=amount, users=users)
+            cancellations.append(cancellation)
+            for debtor_id, creditor_id in edges:
+                add_net(debts, debtor_id, creditor_id, amount)
+                deltas[(debtor_id, creditor_id)] += amount
+                payments.append(
+                    Payment(
+                        payer_id=debtor_id,
+                        payee_id=creditor_id,
+                        amount=amount,
+                        cancellation=cancellation,
+                    )
+                )
+
+        if cancellations:
+            Payment.objects.bulk_create(payments, batch_size=BULK_BATCH_SIZE)
+            DebtAccumulate.record_payments(deltas)
+        return cancellations
 
 
 class DebtAccumulate(models.Model):
-    """Saves the accumulated debt between users"""
+    """Saves the accumulated debt between users
+
+    There is one row per pair of users, the lender is the user with the lower id
+    and the total is the net debt of the borrower to the lender, negative when
+    the lender owes the borrower. The pairs without debts have no row.
+    """
 
     lender = models.ForeignKey(User, related_name="lender", on_delete=models.CASCADE)
     borrower = models.ForeignKey(
@@ -59,39 +420,892 @@ class DebtAccumulate(models.Model):
 
     class Meta:
         unique_together = ("lender", "borrower")
+        constraints = [
+            models.CheckConstraint(
+                check=Q(lender__lt=F("borrower")), name="debt_accumulate_pair_order"
+            ),
+        ]
+
+    @classmethod
+    def add(cls, lender_id, borrower_id, amount):
+        """Add an amount to the accumulated debt of a pair and to their balances
+
+        It must run in a transaction, so the pair and the ledger are updated together.
+        """
+
+        cls.add_many({(lender_id, borrower_id): amount})
+
+    @classmethod
+    def add_many(cls, deltas):
+        """Add the amounts of a dict by (lender id, borrower id) to the pairs
+
+        In write-behind mode the amounts are appended to the AccumulateDelta log
+        instead, and added to the pairs and the balances when the log is folded.
+        """
+
+        if write_behind():
+            cls.changed(AccumulateDelta.append(deltas))
+        else:
+            cls.record_debts(deltas)
+
+    @classmethod
+    def record_debts(cls, deltas):
+        """Add the amounts of a dict by (lender id, borrower id) to the pairs now"""
+
+        pairs = cls.apply(deltas)
+        UserBalance.record(deltas)
+        cls.changed(pairs)
+
+    @classmethod
+    def pay(cls, payer_id, payee_id, amount):
+        """Subtract a payment from the accumulated debt of a pair
+
+        A payment larger than the debt leaves a debt of the payee. It must run in a
+        transaction.
+        """
+
+        cls.record_payments({(payer_id, payee_id): amount})
+
+    @classmethod
+    def record_payments(cls, payments):
+        """Subtract the amounts of a dict by (payer id, payee id) from the pairs"""
+
+        pairs = cls.apply(payments)
+        UserBalance.record_payments(payments)
+        cls.changed(pairs)
+
+    @classmethod
+    def apply(cls, deltas):
+        """Add the debts of a dict by (lender id, borrower id) to the net debts
+
+        The rows are updated in order, so two transactions lock them in the same
+        order. Returns the updated pairs.
+        """
+
+        totals = defaultdict(Decimal)
+        for (lender_id, borrower_id), amount in deltas.items():
+            add_net(totals, lender_id, borrower_id, amount)
+        for (lender_id, borrower_id), amount in sorted(totals.items()):
+            if amount:
+                cls.add_to_pair(lender_id, borrower_id, amount)
+        if materialized():
+            UserObject.update(totals)
+        else:
+            UserObject.outdated()
+        return set(totals)
+
+    @classmethod
+    def add_to_pair(cls, lender_id, borrower_id, amount):
+        """Add an amount to the row of a pair, deleting the row if it gets to zero
+
+        The row is updated unless it would be zero, then it is deleted, and if it
+        doesn't exist it is created. If another transaction creates the row first
+        the amount is added to it.
+        """
+
+        rows = cls.objects.filter(lender_id=lender_id, borrower_id=borrower_id)
+        for attempt in range(2):
+            total = F("total_amount") + amount
+            if rows.exclude(total_amount=-amount).update(total_amount=total):
+                return
+            if rows.filter(total_amount=-amount).delete()[0]:
+                return
+            try:
+                with transaction.atomic():
+                    cls.objects.create(
+                        lender_id=lender_id,
+                        borrower_id=borrower_id,
+                        total_amount=amount,
+                    )
+                return
+            except IntegrityError:
+                if attempt:
+                    raise
+
+    @classmethod
+    def changed(cls, pairs=None):
+        """Notify that the pairs changed, or all of them if pairs is None
+
+        The cached user objects are invalidated now and accumulate_changed is sent
+        after the commit.
+        """
+
+        cache.invalidate(
+            None if pairs is None else {user for pair in pairs for user in pair}
+        )
+        transaction.on_commit(lambda: accumulate_changed.send(sender=cls, pairs=pairs))
+
+    @classmethod
+    def net_rows(cls, query):
+        """Return the net debts of the pairs of a filter
+
+        Every row is a tuple of the lender id and username, the borrower id and
+        username and the total, like the rows of the model. In write-behind mode
+        the rows and the deltas that aren't folded yet are read in one query and
+        added by pair.
+        """
+
+        fields = ("lender_id", "lender__username", "borrower_id", "borrower__username")
+        rows = cls.objects.filter(query).values_list(*fields, "total_amount")
+        if not write_behind():
+            return rows
+
+        deltas = AccumulateDelta.objects.filter(query).annotate(
+            total_amount=F("amount")
+        )
+        deltas = deltas.values_list(*fields, "total_amount")
+        totals = defaultdict(Decimal)
+        for row in rows.union(deltas, all=True):
+            lender, borrower, amount = row[:2], row[2:4], row[4]
+            # The deltas keep the direction of their debts
+            if lender > borrower:
+                lender, borrower, amount = borrower, lender, -amount
+            totals[lender + borrower] += amount
+        return [(*pair, total) for pair, total in totals.items() if total]
+
+    @classmethod
+    def user_debts(cls, user, owed_to_user):
+        """Returns the users that owe the user, or that the user owes, and the amount"""
+
+        debts_dict = {}
+        rows = cls.net_rows(Q(lender=user) | Q(borrower=user))
+        for lender_id, lender, _, borrower, total in rows:
+            # A positive total is owed to the lender
+            if lender_id == user.pk:
+                if (total > 0) == owed_to_user:
+                    debts_dict[borrower] = abs(total)
+            elif (total < 0) == owed_to_user:
+                debts_dict[lender] = abs(total)
+        return debts_dict
 
     @classmethod
     def user_debtors(cls, lender):
         """Returns all the users that have borrowed from the lender and the amount"""
 
-        debts = cls.objects.filter(lender=lender).values(
-            "borrower__username", "total_amount"
-        )
-        owers_dict = {}
-        for item in debts:
-            owers_dict[item["borrower__username"]] = item["total_amount"]
-        return owers_dict
+        return cls.user_debts(lender, owed_to_user=True)
 
     @classmethod
     def user_creditors(cls, borrower):
         """Returns all the users that have lended to the borrower and the amount"""
 
-        debts = cls.objects.filter(borrower=borrower).values(
-            "lender__username", "total_amount"
-        )
-        owed_dict = {}
-        for item in debts:
-            owed_dict[item["lender__username"]] = item["total_amount"]
-        return owed_dict
+        return cls.user_debts(borrower, owed_to_user=False)
 
     @classmethod
     def balance(cls, user):
         """Return the balance of a user"""
 
-        owed_by_dict = cls.user_debtors(user)
-        owes_dict = cls.user_creditors(user)
+        # The balance is kept in the UserBalance ledger, a user without a row
+        # has never lended or borrowed.
+        net = UserBalance.objects.filter(user=user).values_list("net", flat=True)
+        if not write_behind():
+            return net[0] if net else 0
+
+        # The deltas that aren't folded yet are read in the same query
+        deltas = AccumulateDelta.objects.order_by()
+        lent = deltas.filter(lender=user).annotate(net=F("amount"))
+        borrowed = deltas.filter(borrower=user).annotate(net=-F("amount"))
+        return sum(
+            net.union(
+                lent.values_list("net", flat=True),
+                borrowed.values_list("net", flat=True),
+                all=True,
+            )
+        )
+
+    @classmethod
+    def user_summaries(cls, users):
+        """Returns the creditors and the debtors of several users at once
+
+        The result is a dict with the id of every user that has debts as key and
+        a tuple with the owes and owed_by dicts as value. If users is a queryset
+        it is used as a subquery, if not, the ids are sent in batches.
+        """
+
+        if isinstance(users, models.QuerySet):
+            batches = [users.values("pk")]
+        else:
+            ids = [user.pk for user in users]
+            batches = [
+                ids[i : i + SUMMARY_BATCH_SIZE]
+                for i in range(0, len(ids), SUMMARY_BATCH_SIZE)
+            ]
+
+        summaries = {}
+        for batch in batches:
+            rows = cls.net_rows(Q(lender__in=batch) | Q(borrower__in=batch))
+            for lender_id, lender, borrower_id, borrower, amount in rows:
+                # The same row is the owed_by of the creditor and the owes of the
+                # debtor
+                creditor = (lender_id, lender)
+                debtor = (borrower_id, borrower)
+                if amount < 0:
+                    creditor, debtor, amount = debtor, creditor, -amount
+                summaries.setdefault(creditor[0], ({}, {}))[1][debtor[1]] = amount
+                summaries.setdefault(debtor[0], ({}, {}))[0][creditor[1]] = amount
+        return summaries
+
+    @classmethod
+    def rebuild(cls):
+        """Replace the accumulated debts with the net sums of the Debt and Payment
+        rows by pair"""
+
+        # The deltas of the debts are folded first, so they aren't added again
+        AccumulateDelta.fold()
+        totals = defaultdict(Decimal)
+        for model, fields in [
+            (Debt, ("lender_id", "borrower_id")),
+            (Payment, ("payer_id", "payee_id")),
+        ]:
+            sums = model.objects.order_by().values_list(*fields)
+            for lender_id, borrower_id, total in sums.annotate(total=Sum("amount")):
+                add_net(totals, lender_id, borrower_id, total)
+
+        rows = (
+            cls(lender_id=lender_id, borrower_id=borrower_id, total_amount=total)
+            for (lender_id, borrower_id), total in totals.items()
+            if total
+        )
+        count = 0
+        with transaction.atomic():
+            cls.objects.all().delete()
+            batch = list(islice(rows, BULK_BATCH_SIZE))
+            while batch:
+                cls.objects.bulk_create(batch)
+                count += len(batch)
+                batch = list(islice(rows, BULK_BATCH_SIZE))
+            if materialized():
+                UserObject.rebuild()
+            else:
+                UserObject.outdated()
+            cls.changed()
+        return count
+
+
+class AccumulateDelta(models.Model):
+    """Log of the debts not added yet to the accumulated debts
+
+    In write-behind mode the debts only append their amounts to the log, and the
+    log is folded into the accumulated debts and the balances in batches, with one
+    update per pair.
+    """
+
+    lender = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    borrower = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def append(cls, deltas):
+        """Append the amounts of a dict by (lender id, borrower id) to the log
+
+        Returns the changed (lower id, higher id) pairs.
+        """
+
+        cls.objects.bulk_create(
+            [
+                cls(lender_id=lender_id, borrower_id=borrower_id, amount=amount)
+                for (lender_id, borrower_id), amount in deltas.items()
+            ],
+            batch_size=BULK_BATCH_SIZE,
+        )
+        return {(min(pair), max(pair)) for pair in deltas}
+
+    @classmethod
+    def fold(cls, batch_size=SUMMARY_BATCH_SIZE):
+        """Add the deltas of the log to the accumulated debts and delete them
+
+        The deltas are folded in order in transactions of batch_size deltas. The
+        deltas of a batch are locked, skipping the ones of other folds, and a batch
+        is only added if all its deltas are deleted by this fold, otherwise it is
+        rolled back and read again. Returns the number of folded deltas.
+        """
+
+        if batch_size < 1:
+            raise ValueError("The batch size must be at least 1")
+
+        def fold():
+            rows = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .order_by("id")
+                .values_list("id", "lender_id", "borrower_id", "amount")[:batch_size]
+            )
+            deltas = defaultdict(Decimal)
+            for _, lender_id, borrower_id, amount in rows:
+                deltas[(lender_id, borrower_id)] += amount
+            if rows:
+                ids = [row[0] for row in rows]
+                # Another fold deleted some of the deltas after they were read
+                if cls.objects.filter(id__in=ids).delete()[0] != len(rows):
+                    transaction.set_rollback(True)
+                    return None
+                DebtAccumulate.record_debts(deltas)
+            return len(rows)
+
+        folded = 0
+        while True:
+            count = run_with_retries(fold)
+            if count is None:
+                continue
+            folded += count
+            if count < batch_size:
+                return folded
+
+
+class UserBalance(models.Model):
+    """Saves the totals lended, borrowed, paid and received by a user and their
+    balance"""
+
+    user = models.OneToOneField(
+        User, primary_key=True, related_name="balance", on_delete=models.CASCADE
+    )
+    credit_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    debit_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    received_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    net = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    @classmethod
+    def add(cls, user_id, credit=0, debit=0, paid=0, received=0):
+        """Add the credit, the debit and the payments to the totals of a user"""
+
+        deltas = {
+            "credit_total": credit,
+            "debit_total": debit,
+            "paid_total": paid,
+            "received_total": received,
+            "net": credit - debit + paid - received,
+        }
+        increment(cls, {"user_id": user_id}, deltas)
+
+    @classmethod
+    def record(cls, deltas):
+        """Update the balances with the amounts of a dict by (lender id, borrower id)"""
+
+        totals = {}
+        for (lender_id, borrower_id), amount in deltas.items():
+            totals.setdefault(lender_id, [0, 0])[0] += amount
+            totals.setdefault(borrower_id, [0, 0])[1] += amount
+        for user_id, (credit, debit) in sorted(totals.items()):
+            cls.add(user_id, credit=credit, debit=debit)
+
+    @classmethod
+    def record_payments(cls, payments):
+        """Update the balances with the amounts of a dict by (payer id, payee id)"""
+
+        totals = {}
+        for (payer_id, payee_id), amount in payments.items():
+            totals.setdefault(payer_id, [0, 0])[0] += amount
+            totals.setdefault(payee_id, [0, 0])[1] += amount
+        for user_id, (paid, received) in sorted(totals.items()):
+            cls.add(user_id, paid=paid, received=received)
+
+    @classmethod
+    def compute(cls):
+        """Returns the balances computed from the Debt and Payment rows by user id"""
+
+        # Without order_by() the ordering of Debt is added to the GROUP BY
+        sources = [
+            (Debt, "lender_id", "credit_total"),
+            (Debt, "borrower_id", "debit_total"),
+            (Payment, "payer_id", "paid_total"),
+            (Payment, "payee_id", "received_total"),
+        ]
+        balances = {}
+        for model, user_field, total_field in sources:
+            totals = model.objects.order_by().values(user_field)
+            for item in totals.annotate(total=Sum("amount")):
+                user_id = item[user_field]
+                balance = balances.get(user_id)
+                if balance is None:
+                    balance = balances[user_id] = cls(user_id=user_id)
+                setattr(balance, total_field, item["total"])
+        for balance in balances.values():
+            balance.net = (
+                balance.credit_total
+                - balance.debit_total
+                + balance.paid_total
+                - balance.received_total
+            )
+        return balances
+
+    @classmethod
+    def rebuild(cls):
+        """Replace the ledger with the balances computed from the Debt rows"""
+
+        AccumulateDelta.fold()
+        balances = cls.compute()
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(balances.values(), batch_size=BULK_BATCH_SIZE)
+        return len(balances)
+
+    def totals(self):
+        """Returns the totals and the net of the row"""
+
+        return (
+            self.credit_total,
+            self.debit_total,
+            self.paid_total,
+            self.received_total,
+            self.net,
+        )
+
+    @classmethod
+    def verify(cls):
+        """Returns the ids of the users whose ledger row differs from the Debt rows"""
+
+        AccumulateDelta.fold()
+        expected = cls.compute()
+        mismatches = []
+        for balance in cls.objects.iterator():
+            computed = expected.pop(balance.user_id, None)
+            if computed is None:
+                if any(balance.totals()):
+                    mismatches.append(balance.user_id)
+            elif balance.totals() != computed.totals():
+                mismatches.append(balance.user_id)
+        # The users left have debts but no row in the ledger
+        mismatches.extend(expected)
+        return sorted(mismatches)
+
+
+class UserObject(models.Model):
+    """Saves the user object of a user, with the amounts in cents by username
+
+    With the DEBTS_USER_OBJECTS setting the rows are updated in the transactions
+    that change the accumulated debts, so the user objects are read without
+    reading the debts and the names of the other users. Without the setting the
+    changes don't update the rows, so the rows are only read while they are
+    complete, from their last rebuild until a change without the setting.
+    """
+
+    user = models.OneToOneField(
+        User, primary_key=True, related_name="user_object", on_delete=models.CASCADE
+    )
+    owes = models.JSONField(default=dict)
+    owed_by = models.JSONField(default=dict)
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    def set_balance(self):
+        """Set the balance from the owes and owed_by maps"""
+
+        self.balance = (sum(self.owed_by.values()) - sum(self.owes.values())) * CENT
+
+    def values(self):
+        """Returns the owes, owed_by and balance of the row"""
+
+        return self.owes, self.owed_by, self.balance
+
+    @classmethod
+    def update(cls, pairs):
+        """Write again the debts of the (lower id, higher id) pairs in the rows of
+        their users
+
+        It must run in the transaction that changed the pairs, the rows are locked
+        in order.
+        """
+
+        pairs = sorted(pairs)
+        for i in range(0, len(pairs), SUMMARY_BATCH_SIZE):
+            batch = pairs[i : i + SUMMARY_BATCH_SIZE]
+            user_ids = sorted({user_id for pair in batch for user_id in pair})
+            rows = DebtAccumulate.objects.filter(
+                lender_id__in={low for low, _ in batch},
+                borrower_id__in={high for _, high in batch},
+            ).values_list("lender_id", "borrower_id", "total_amount")
+            totals = {(lender, borrower): total for lender, borrower, total in rows}
+            names = dict(
+                User.objects.filter(pk__in=user_ids).values_list("id", "username")
+            )
+
+            # The missing rows are created first, so every row is locked
+            objects = cls.objects.select_for_update().in_bulk(user_ids)
+            missing = [
+                cls(user_id=user_id) for user_id in user_ids if user_id not in objects
+            ]
+            if missing:
+                cls.objects.bulk_create(missing, ignore_conflicts=True)
+                objects = cls.objects.select_for_update().in_bulk(user_ids)
+
+            for low, high in batch:
+                for user_id, other_id in ((low, high), (high, low)):
+                    objects[user_id].owes.pop(names[other_id], None)
+                    objects[user_id].owed_by.pop(names[other_id], None)
+                # A positive total is a debt of the higher id
+                cents = int(totals.get((low, high), 0) / CENT)
+                if cents < 0:
+                    low, high, cents = high, low, -cents
+                if cents:
+                    objects[high].owes[names[low]] = cents
+                    objects[low].owed_by[names[high]] = cents
+
+            for user_object in objects.values():
+                user_object.set_balance()
+            cls.objects.bulk_update(
+                [objects[user_id] for user_id in user_ids],
+                ["owes", "owed_by", "balance"],
+            )
+
+    @classmethod
+    def summaries(cls, users):
+        """Returns the owes and owed_by dicts of the users with debts by user id
+
+        It's the same as DebtAccumulate.user_summaries, read from the rows.
+        """
+
+        if isinstance(users, models.QuerySet):
+            batches = [users.values("pk")]
+        else:
+            ids = [user.pk for user in users]
+            batches = [
+                ids[i : i + SUMMARY_BATCH_SIZE]
+                for i in range(0, len(ids), SUMMARY_BATCH_SIZE)
+            ]
+
+        summaries = {}
+        for batch in batches:
+            rows = cls.objects.filter(user__in=batch).values_list(
+                "user_id", "owes", "owed_by"
+            )
+            for user_id, owes, owed_by in rows:
+                if owes or owed_by:
+                    summaries[user_id] = tuple(
+                        {name: cents * CENT for name, cents in debts.items()}
+                        for debts in (owes, owed_by)
+                    )
+        return summaries
+
+    @classmethod
+    def compute(cls):
+        """Returns the rows computed from the accumulated debts by user id"""
+
+        objects = {}
+        rows = DebtAccumulate.objects.values_list(
+            "lender_id",
+            "lender__username",
+            "borrower_id",
+            "borrower__username",
+            "total_amount",
+        )
+        for lender_id, lender, borrower_id, borrower, total in rows.iterator():
+            creditor, debtor = (lender_id, lender), (borrower_id, borrower)
+            cents = int(total / CENT)
+            if cents < 0:
+                creditor, debtor, cents = debtor, creditor, -cents
+            for user_id, _ in (creditor, debtor):
+                if user_id not in objects:
+                    objects[user_id] = cls(user_id=user_id)
+            objects[creditor[0]].owed_by[debtor[1]] = cents
+            objects[debtor[0]].owes[creditor[1]] = cents
+        for user_object in objects.values():
+            user_object.set_balance()
+        return objects
+
+    @staticmethod
+    def complete():
+        """Returns True if the rows have the debts of every user"""
+
+        return UserObjectsRebuild.objects.exists()
+
+    @staticmethod
+    def outdated():
+        """Mark the rows as incomplete, the accumulated debts changed without them
 
-        owed_by_sum = sum(owed_by_dict.values())
-        owes_sum = sum(owes_dict.values())
+        It must run in the transaction that changed the accumulated debts.
+        """
+
+        UserObjectsRebuild.objects.all().delete()
+
+    @classmethod
+    def rebuild(cls):
+        """Replace the rows with the rows computed from the accumulated debts and
+        mark them as complete"""
+
+        with transaction.atomic():
+            objects = cls.compute()
+            cls.objects.all().delete()
+            cls.objects.bulk_create(objects.values(), batch_size=BULK_BATCH_SIZE)
+            UserObjectsRebuild.objects.all().delete()
+            UserObjectsRebuild.objects.create()
+        return len(objects)
+
+    @classmethod
+    def verify(cls):
+        """Returns the ids of the users whose row differs from the accumulated debts"""
+
+        expected = cls.compute()
+        mismatches = []
+        for user_object in cls.objects.iterator():
+            computed = expected.pop(user_object.user_id, None)
+            if computed is None:
+                if user_object.owes or user_object.owed_by or user_object.balance:
+                    mismatches.append(user_object.user_id)
+            elif user_object.values() != computed.values():
+                mismatches.append(user_object.user_id)
+        # The users left have debts but no row
+        mismatches.extend(expected)
+        return sorted(mismatches)
+
+
+class UserObjectsRebuild(models.Model):
+    """Saves when the UserObject rows were rebuilt
+
+    There is a row while the UserObject rows are complete, it is deleted by the
+    changes of the accumulated debts that don't update them.
+    """
+
+    rebuilt_at = models.DateTimeField(default=timezone.now)
+
+
+class BalanceSnapshot(models.Model):
+    """Saves the debts of every user as they were at a time
+
+    The debts of the users are in UserSnapshot rows. The state at any time is
+    the nearest previous snapshot plus the debts and payments created after it.
+    """
+
+    taken_at = models.DateTimeField(unique=True)
+
+    class Meta:
+        ordering = ["-taken_at"]
+
+    @staticmethod
+    def replay(start, end, totals, user=None):
+        """Add the debts and the payments created between start and end to the totals
+
+        The totals are the net debts in cents by pair, as in add_net. The start is
+        excluded and None for everything until end. With a user only its debts and
+        payments are replayed.
+        """
+
+        for model, fields in [
+            (Debt, ("lender_id", "borrower_id")),
+            (Payment, ("payer_id", "payee_id")),
+        ]:
+            query = model.objects.order_by().filter(created_at__lte=end)
+            if start is not None:
+                query = query.filter(created_at__gt=start)
+            if user is not None:
+                query = query.filter(
+                    Q(**{fields[0]: user.pk}) | Q(**{fields[1]: user.pk})
+                )
+            sums = query.values_list(*fields).annotate(total=Sum("amount"))
+            for lender_id, borrower_id, total in sums:
+                add_net(totals, lender_id, borrower_id, int(total / CENT))
+        return totals
+
+    @classmethod
+    def nearest(cls, timestamp):
+        """Return the latest snapshot taken at or before the timestamp, or None"""
+
+        return cls.objects.filter(taken_at__lte=timestamp).first()
+
+    @classmethod
+    def take(cls, taken_at=None):
+        """Save the debts of every user at a time and return the snapshot
+
+        The debts are the ones of the previous snapshot plus the debts and payments
+        created after it. By default the time is SNAPSHOT_DELAY ago, a debt created
+        before the snapshot but committed after it would be missing.
+        """
+
+        taken_at = taken_at or timezone.now() - SNAPSHOT_DELAY
+        previous = cls.nearest(taken_at)
+        if previous is not None and previous.taken_at == taken_at:
+            return previous
+
+        totals = defaultdict(int)
+        if previous is not None:
+            # The owed_by of the lenders have every pair of the snapshot
+            entries = previous.users.values_list("user_id", "owed_by")
+            for lender_id, owed_by in entries.iterator():
+                for borrower_id, cents in owed_by.items():
+                    add_net(totals, lender_id, int(borrower_id), cents)
+        cls.replay(previous and previous.taken_at, taken_at, totals)
+
+        users = defaultdict(lambda: ({}, {}))
+        for lender_id, borrower_id, cents in directed_debts(totals):
+            users[lender_id][1][str(borrower_id)] = cents
+            users[borrower_id][0][str(lender_id)] = cents
+
+        with transaction.atomic():
+            snapshot = cls.objects.create(taken_at=taken_at)
+            UserSnapshot.objects.bulk_create(
+                (
+                    UserSnapshot(
+                        snapshot=snapshot,
+                        user_id=user_id,
+                        owes=owes,
+                        owed_by=owed_by,
+                        balance=(sum(owed_by.values()) - sum(owes.values())) * CENT,
+                    )
+                    for user_id, (owes, owed_by) in users.items()
+                ),
+                batch_size=BULK_BATCH_SIZE,
+            )
+        return snapshot
+
+    @classmethod
+    def compact(cls, keep):
+        """Delete the old snapshots, except the last one of every day
+
+        The newest keep snapshots are kept. Returns the number of deleted snapshots.
+        """
+
+        days = set()
+        deleted = []
+        snapshots = cls.objects.values_list("pk", "taken_at")[keep:]
+        for pk, taken_at in snapshots.iterator():
+            day = timezone.localdate(taken_at)
+            if day in days:
+                deleted.append(pk)
+            days.add(day)
+        for i in range(0, len(deleted), BULK_BATCH_SIZE):
+            cls.objects.filter(pk__in=deleted[i : i + BULK_BATCH_SIZE]).delete()
+        return len(deleted)
+
+    @classmethod
+    def balance_as_of(cls, user, timestamp):
+        """Returns the owes, owed_by and balance of a user at a time
+
+        The debts come from the nearest snapshot and the debts and payments of the
+        user created after it, the amounts are Decimal by username.
+        """
+
+        snapshot = cls.nearest(timestamp)
+        totals = defaultdict(int)
+        if snapshot is not None:
+            entry = snapshot.users.filter(user=user).first()
+            if entry is not None:
+                for user_id, cents in entry.owes.items():
+                    add_net(totals, int(user_id), user.pk, cents)
+                for user_id, cents in entry.owed_by.items():
+                    add_net(totals, user.pk, int(user_id), cents)
+        cls.replay(snapshot and snapshot.taken_at, timestamp, totals, user)
+
+        owes = {}
+        owed_by = {}
+        for lender_id, borrower_id, cents in directed_debts(totals):
+            if lender_id == user.pk:
+                owed_by[borrower_id] = cents
+            else:
+                owes[lender_id] = cents
+
+        names = dict(
+            User.objects.filter(pk__in=set(owes) | set(owed_by)).values_list(
+                "pk", "username"
+            )
+        )
+        # The debts of deleted users were deleted with them
+        owes = {
+            names[user_id]: cents * CENT
+            for user_id, cents in owes.items()
+            if user_id in names
+        }
+        owed_by = {
+            names[user_id]: cents * CENT
+            for user_id, cents in owed_by.items()
+            if user_id in names
+        }
+        return {
+            "owes": owes,
+            "owed_by": owed_by,
+            "balance": sum(owed_by.values()) - sum(owes.values()),
+        }
+
+
+class UserSnapshot(models.Model):
+    """Saves the debts of a user in a snapshot
+
+    The owes and owed_by maps have the amounts in cents by user id.
+    """
+
+    snapshot = models.ForeignKey(
+        BalanceSnapshot, related_name="users", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(User, related_name="snapshots", on_delete=models.CASCADE)
+    owes = models.JSONField(default=dict)
+    owed_by = models.JSONField(default=dict)
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+
+    class Meta:
+        unique_together = ("snapshot", "user")
+
+
+class ExpirationWatermark(models.Model):
+    """Saves how far a consumer of the expired debts processed them
+
+    The debts that expire after they are created are processed by expiration date
+    and id, and the debts that are created already expired by creation time and
+    id. The watermark has the position of the last processed debt of each order,
+    and the time where the consumer started, the debts that expired before aren't
+    processed even if they are created later.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    expiration_date = models.DateTimeField()
+    expiration_debt_id = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField()
+    created_debt_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class IdempotencyKey(models.Model):
+    """Saves the response of a request with an Idempotency-Key header
+
+    A retry of the request with the same key returns the saved response instead of
+    writing again. The keys are kept for DEBTS_IDEMPOTENCY_TIMEOUT seconds.
+    """
+
+    key = models.CharField(max_length=255, unique=True)
+    # Hash of the data of the request, a key can't be reused for other data
+    fingerprint = models.CharField(max_length=64)
+    response = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @staticmethod
+    def expiration():
+        """Return the time before which the keys are expired"""
+
+        timeout = getattr(settings, "DEBTS_IDEMPOTENCY_TIMEOUT", 24 * 60 * 60)
+        return timezone.now() - timedelta(seconds=timeout)
+
+    @classmethod
+    def run(cls, key, fingerprint, function):
+        """Return the saved response of the key, or the response of the function
+
+        The function runs in the transaction that saves its response with the key,
+        so its writes are rolled back if another request saves the key first, and
+        the saved response of that request is returned.
+        """
+
+        if len(key) > cls._meta.get_field("key").max_length:
+            raise ValidationError("The Idempotency-Key is too long")
+
+        def run():
+            saved = cls.objects.filter(key=key).first()
+            if saved is not None and saved.created_at < cls.expiration():
+                saved.delete()
+                saved = None
+            if saved is not None:
+                if saved.fingerprint != fingerprint:
+                    raise ValidationError(
+                        "The Idempotency-Key was used by a different request"
+                    )
+                return saved.response
+
+            response = function()
+            cls.objects.create(key=key, fingerprint=fingerprint, response=response)
+            return response
+
+        try:
+            return run_with_retries(run)
+        except IntegrityError:
+            return run_with_retries(run)
+
+    @classmethod
+    def purge(cls):
+        """Delete the expired keys and return how many were deleted"""
 
-        return owed_by_sum - owes_sum
+        return cls.objects.filter(created_at__lt=cls.expiration()).delete()[0]
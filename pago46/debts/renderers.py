@@ -0,0 +1,100 @@
+# encoding: utf-8
+"""Renderers for the api"""
+
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# orjson is optional, without it the JSON is encoded by the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data):
+    """Return the data as compact JSON bytes, with orjson if it is installed"""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def fixed_point(amount):
+    """Return an amount as a string with two decimals"""
+
+    return f"{amount:.2f}"
+
+
+def cents(amount):
+    """Return an amount as an integer number of cents"""
+
+    return int(amount * 100)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Renders a list as newline delimited JSON, one item per line"""
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """Return the items of the list in lines"""
+
+        if data is None:
+            return b""
+        if not isinstance(data, list):
+            data = [data]
+        return b"".join(self.render_line(item) for item in data)
+
+    @staticmethod
+    def render_line(item):
+        """Return an item as a line of JSON"""
+
+        return json.dumps(item, cls=JSONEncoder).encode() + b"\n"
+
+
+class UserRowsRenderer(BaseRenderer):
+    """Renders the (name, owes, owed_by, balance) rows of users as user objects
+
+    The amounts are strings with two decimals, or integer cents with the
+    amounts=cents parameter, so they are encoded exactly without going through
+    the encoder of the Decimal values. The rows can be a list or the results of a
+    page, any other data is rendered as it is.
+    """
+
+    media_type = "application/json"
+    format = "compact"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """Return the user objects of the rows as JSON"""
+
+        if data is None:
+            return b""
+        request = (renderer_context or {}).get("request")
+        amount = fixed_point
+        if request is not None and request.query_params.get("amounts") == "cents":
+            amount = cents
+
+        if isinstance(data, list):
+            data = self.user_objects(data, amount)
+        elif isinstance(data, dict) and "results" in data:
+            data = {**data, "results": self.user_objects(data["results"], amount)}
+        return dumps(data)
+
+    @staticmethod
+    def user_objects(rows, amount):
+        """Return the user objects of the rows with the amounts converted"""
+
+        return [
+            {
+                "name": name,
+                "owes": {other: amount(value) for other, value in owes.items()},
+                "owed_by": {other: amount(value) for other, value in owed_by.items()},
+                "balance": amount(balance),
+            }
+            for name, owes, owed_by, balance in rows
+        ]
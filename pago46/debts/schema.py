@@ -1,15 +1,30 @@
 # encoding: utf-8
 """Schema for the graphene api"""
 
+import base64
+from datetime import datetime as datetime_type, timedelta
+from itertools import islice
+
 import graphene
 from graphene_django import DjangoObjectType
+from graphql import GraphQLError
 
 from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.utils import timezone
 
-from .models import Debt
+from . import graph
+from .models import CENT, Debt
 
 User = get_user_model()
 
+# Default and maximum number of debts in a page of a connection
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Maximum number of debts between a user and its neighbours
+MAX_HOPS = 6
+
 
 class UserType(DjangoObjectType):
     """User Type for graphene"""
@@ -22,20 +37,244 @@ class UserType(DjangoObjectType):
 class DebtType(DjangoObjectType):
     """Debt Type for graphene"""
 
+    # graphene-django reads the users of the foreign keys again by id, these
+    # fields use the users already selected with the debt.
+    lender = graphene.Field(UserType, required=True)
+    borrower = graphene.Field(UserType, required=True)
+
     class Meta:
         model = Debt
         fields = ("lender", "borrower", "amount", "expiration_date")
 
+    def resolve_lender(self, info):
+        """Return the lender of the debt"""
+
+        return self.lender
+
+    def resolve_borrower(self, info):
+        """Return the borrower of the debt"""
+
+        return self.borrower
+
+
+class NeighbourType(graphene.ObjectType):
+    """User near another user in the graph of debts"""
+
+    user = graphene.Field(UserType, required=True)
+    hops = graphene.Int(required=True)
+
+
+class ComponentType(graphene.ObjectType):
+    """Group of users connected by debts"""
+
+    size = graphene.Int(required=True)
+    users = graphene.List(graphene.NonNull(UserType), required=True)
+
+    def resolve_size(self, info):
+        """Return the number of users of the component"""
+
+        return len(self)
+
+    def resolve_users(self, info):
+        """Return the users of the component, ordered by username"""
+
+        return User.objects.filter(pk__in=self).order_by("username")
+
+
+class CycleDebtType(graphene.ObjectType):
+    """Accumulated debt of a cycle"""
+
+    lender = graphene.Field(UserType, required=True)
+    borrower = graphene.Field(UserType, required=True)
+    amount = graphene.Decimal(required=True)
+
+
+class CycleType(graphene.ObjectType):
+    """Cycle of debts, every debt can be reduced by the amount of the cycle"""
+
+    debts = graphene.List(graphene.NonNull(CycleDebtType), required=True)
+    amount = graphene.Decimal(required=True)
+
+
+def cycle_object(debts, users):
+    """Return the CycleType of the (debtor id, creditor id, cents) of a cycle"""
+
+    return CycleType(
+        debts=[
+            CycleDebtType(
+                lender=users[creditor_id],
+                borrower=users[debtor_id],
+                amount=cents * CENT,
+            )
+            for debtor_id, creditor_id, cents in debts
+        ],
+        amount=min(cents for _, _, cents in debts) * CENT,
+    )
+
+
+class DebtConnection(graphene.relay.Connection):
+    """Relay connection of debts"""
+
+    class Meta:
+        node = DebtType
+
+
+def encode_cursor(debt):
+    """Return the cursor of a debt, its expiration date and id"""
+
+    value = f"{debt.expiration_date.isoformat()}|{debt.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the expiration date and the id of a cursor"""
+
+    try:
+        expiration_date, id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime_type.fromisoformat(expiration_date), int(id)
+    except ValueError:
+        raise GraphQLError("Invalid cursor")
+
 
 class Query(graphene.ObjectType):
     """Query class for graphene"""
 
     expired_debts = graphene.List(DebtType, datetime=graphene.DateTime())
+    expired_debts_connection = graphene.relay.ConnectionField(
+        DebtConnection, datetime=graphene.DateTime(required=True)
+    )
+    expiring_debts = graphene.List(
+        graphene.NonNull(DebtType),
+        hours=graphene.Float(default_value=24),
+        first=graphene.Int(default_value=PAGE_SIZE),
+    )
+
+    debt_neighbours = graphene.List(
+        graphene.NonNull(NeighbourType),
+        username=graphene.String(required=True),
+        hops=graphene.Int(default_value=2),
+    )
+    debt_components = graphene.List(
+        graphene.NonNull(ComponentType),
+        min_size=graphene.Int(default_value=2),
+        first=graphene.Int(default_value=PAGE_SIZE),
+    )
+    debt_cycles = graphene.List(
+        graphene.NonNull(CycleType),
+        username=graphene.String(),
+        first=graphene.Int(default_value=PAGE_SIZE),
+    )
 
     def resolve_expired_debts(self, info, datetime):
         """Return the debts that expires after the datetime"""
 
-        return Debt.objects.filter(expiration_date__lt=datetime)
+        return Debt.objects.filter(expiration_date__lt=datetime).select_related(
+            "lender", "borrower"
+        )
+
+    def resolve_expired_debts_connection(
+        self, info, datetime, first=None, after=None, **kwargs
+    ):
+        """Return a page of the debts that expired before the datetime
+
+        The debts are ordered by expiration date and id, from the latest, and the
+        page starts after the debt of the cursor, so only the debts of the page are
+        read.
+        """
+
+        first = PAGE_SIZE if first is None else first
+        if not 0 <= first <= MAX_PAGE_SIZE:
+            raise GraphQLError(f"first must be between 0 and {MAX_PAGE_SIZE}")
+
+        debts = (
+            Debt.objects.filter(expiration_date__lt=datetime)
+            .select_related("lender", "borrower")
+            .order_by("-expiration_date", "-id")
+        )
+        if after:
+            expiration_date, id = decode_cursor(after)
+            debts = debts.filter(
+                Q(expiration_date__lt=expiration_date)
+                | Q(expiration_date=expiration_date, id__lt=id)
+            )
+
+        # One more debt tells if there is a next page
+        debts = list(debts[: first + 1])
+        edges = [
+            DebtConnection.Edge(node=debt, cursor=encode_cursor(debt))
+            for debt in debts[:first]
+        ]
+        return DebtConnection(
+            edges=edges,
+            page_info=graphene.relay.PageInfo(
+                has_next_page=len(debts) > first,
+                has_previous_page=bool(after),
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+            ),
+        )
+
+    def resolve_expiring_debts(self, info, hours, first):
+        """Return the next debts that expire in the following hours"""
+
+        if hours <= 0:
+            raise GraphQLError("hours must be positive")
+        if not 0 <= first <= MAX_PAGE_SIZE:
+            raise GraphQLError(f"first must be between 0 and {MAX_PAGE_SIZE}")
+        now = timezone.now()
+        return Debt.expiring(now, now + timedelta(hours=hours))[:first]
+
+    def resolve_debt_neighbours(self, info, username, hops):
+        """Return the users at most hops debts away from the user, in any direction"""
+
+        if not 1 <= hops <= MAX_HOPS:
+            raise GraphQLError(f"hops must be between 1 and {MAX_HOPS}")
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            raise GraphQLError(f"There is no user {username}")
+
+        distances = graph.read(lambda debts: debts.neighbourhood(user.pk, hops))
+        users = User.objects.in_bulk(distances)
+        return sorted(
+            (
+                NeighbourType(user=users[user_id], hops=distance)
+                for user_id, distance in distances.items()
+                if user_id in users
+            ),
+            key=lambda neighbour: (neighbour.hops, neighbour.user.username),
+        )
+
+    def resolve_debt_components(self, info, min_size, first):
+        """Return the largest groups of users connected by debts"""
+
+        if not 0 <= first <= MAX_PAGE_SIZE:
+            raise GraphQLError(f"first must be between 0 and {MAX_PAGE_SIZE}")
+        components = graph.read(lambda debts: debts.components())
+        return [
+            component for component in components if len(component) >= min_size
+        ][:first]
+
+    def resolve_debt_cycles(self, info, first, username=None):
+        """Return cycles of debts, through the user or one per group of users
+
+        The debts of a cycle can be cancelled by its amount without changing the
+        balances.
+        """
+
+        if not 0 <= first <= MAX_PAGE_SIZE:
+            raise GraphQLError(f"first must be between 0 and {MAX_PAGE_SIZE}")
+        user_id = None
+        if username is not None:
+            user = User.objects.filter(username=username).first()
+            if user is None:
+                raise GraphQLError(f"There is no user {username}")
+            user_id = user.pk
+
+        cycles = graph.read(lambda debts: list(islice(debts.cycles(user_id), first)))
+        users = User.objects.in_bulk(
+            {user_id for cycle in cycles for debt in cycle for user_id in debt[:2]}
+        )
+        return [cycle_object(cycle, users) for cycle in cycles]
 
 
 schema = graphene.Schema(query=Query)
@@ -5,7 +5,7 @@ from django.contrib.auth.models import User
 
 from rest_framework import routers, serializers, viewsets
 
-from .models import Debt
+from .models import Debt, Payment
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -22,3 +22,25 @@ class DebtSerializer(serializers.ModelSerializer):
     class Meta:
         model = Debt
         fields = ["lender", "borrower", "amount", "expiration_date"]
+
+
+class PaymentSerializer(serializers.ModelSerializer):
+    """Serializer for Payment model, with the users by username"""
+
+    payer = serializers.SlugRelatedField(
+        slug_field="username", queryset=User.objects.all()
+    )
+    payee = serializers.SlugRelatedField(
+        slug_field="username", queryset=User.objects.all()
+    )
+
+    class Meta:
+        model = Payment
+        fields = ["payer", "payee", "amount"]
+
+    def validate(self, data):
+        """The payer and the payee can't be the same user"""
+
+        if data["payer"] == data["payee"]:
+            raise serializers.ValidationError("Payer and payee can't be the same")
+        return data
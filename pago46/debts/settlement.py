@@ -0,0 +1,152 @@
+# encoding: utf-8
+"""Planner of the transfers that settle the debts of a group of users"""
+
+import heapq
+from decimal import Decimal
+
+from django.db.models import Sum
+
+from .models import CENT, AccumulateDelta, DebtAccumulate, write_behind
+
+# Maximum number of users with a balance to search the minimal plan, the search
+# takes 2^n steps.
+EXACT_MAX_USERS = 12
+
+
+def net_balances(users=None):
+    """Returns the net balance of the users by username
+
+    The balances come from the accumulated debts between the users, so with a
+    queryset of users only the debts inside the group are counted and the
+    balances sum zero.
+    """
+
+    debts = DebtAccumulate.objects.order_by()
+    deltas = AccumulateDelta.objects.order_by()
+    if users is not None:
+        debts = debts.filter(lender__in=users, borrower__in=users)
+        deltas = deltas.filter(lender__in=users, borrower__in=users)
+
+    balances = {}
+    credits = debts.values("lender__username").annotate(total=Sum("total_amount"))
+    debits = debts.values("borrower__username").annotate(total=Sum("total_amount"))
+    if write_behind():
+        # The deltas that aren't folded yet are read in the same queries
+        credits = credits.union(
+            deltas.values("lender__username").annotate(total=Sum("amount")), all=True
+        )
+        debits = debits.union(
+            deltas.values("borrower__username").annotate(total=Sum("amount")),
+            all=True,
+        )
+    for item in credits:
+        name = item["lender__username"]
+        balances[name] = balances.get(name, 0) + item["total"]
+    for item in debits:
+        name = item["borrower__username"]
+        balances[name] = balances.get(name, 0) - item["total"]
+    return balances
+
+
+def greedy_transfers(balances):
+    """Returns the transfers of a plan that pays the largest debts first
+
+    The balances are in cents by name, the plan has at most one transfer less
+    than the number of users with a balance.
+    """
+
+    creditors = [(-amount, name) for name, amount in balances.items() if amount > 0]
+    debtors = [(amount, name) for name, amount in balances.items() if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debit, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debit)
+        transfers.append((debtor, creditor, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debit > amount:
+            heapq.heappush(debtors, (debit + amount, debtor))
+    return transfers
+
+
+def exact_transfers(balances):
+    """Returns a plan with the minimum number of transfers
+
+    A group of users whose balances sum zero can be settled with one transfer less
+    than its size, so the plan splits the users in as many zero sum groups as
+    possible and settles every group with the greedy plan.
+    """
+
+    names = [name for name, amount in balances.items() if amount]
+    size = len(names)
+    full = (1 << size) - 1
+
+    # The sum of the balances of every subset of users
+    sums = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + balances[names[low.bit_length() - 1]]
+
+    # The maximum number of zero sum groups in which every subset can be split,
+    # adding the users one by one.
+    groups = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        best = 0
+        bits = mask
+        while bits:
+            low = bits & -bits
+            best = max(best, groups[mask ^ low])
+            bits ^= low
+        groups[mask] = best + (sums[mask] == 0)
+
+    # Remove the users in an order that keeps the maximum, the groups are the
+    # users between the subsets that sum zero.
+    plan = []
+    group = {}
+    mask = full
+    while mask:
+        if sums[mask] == 0 and group:
+            plan.extend(greedy_transfers(group))
+            group = {}
+        bits = mask
+        while bits:
+            low = bits & -bits
+            if groups[mask ^ low] + (sums[mask] == 0) == groups[mask]:
+                break
+            bits ^= low
+        name = names[low.bit_length() - 1]
+        group[name] = balances[name]
+        mask ^= low
+    plan.extend(greedy_transfers(group))
+    return plan
+
+
+def plan_transfers(balances, exact=None):
+    """Returns the (debtor, creditor, amount) transfers that settle the balances
+
+    The balances are Decimal by name and must sum zero. The exact plan is used by
+    default for up to EXACT_MAX_USERS users with a balance.
+    """
+
+    cents = {
+        name: int((Decimal(amount) / CENT).to_integral_value())
+        for name, amount in balances.items()
+        if amount
+    }
+    if sum(cents.values()):
+        raise ValueError("The balances must sum zero")
+    if exact is None:
+        exact = len(cents) <= EXACT_MAX_USERS
+    if exact and len(cents) > EXACT_MAX_USERS:
+        raise ValueError(
+            f"The exact plan can't be used for more than {EXACT_MAX_USERS} users"
+        )
+
+    transfers = exact_transfers(cents) if exact else greedy_transfers(cents)
+    return [
+        (debtor, creditor, amount * CENT) for debtor, creditor, amount in transfers
+    ]
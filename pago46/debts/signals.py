@@ -0,0 +1,14 @@
+# encoding: utf-8
+"""Signals of the debts app"""
+
+from django.dispatch import Signal
+
+# Sent after the commit of a change of the accumulated debts, with the set of
+# changed (lower user id, higher user id) pairs in pairs, or None if any pair
+# could have changed.
+accumulate_changed = Signal()
+
+# Sent by the expiration scheduler for every batch of newly expired debts, with
+# the list of debts in the order they expired in debts and the name of the
+# consumer in name.
+debts_expired = Signal()
@@ -1,19 +1,72 @@
 # encoding: utf-8
 """Tests of debts app"""
 
+import asyncio
+import io
+import json
+import pstats
+import threading
+import time
 from datetime import datetime, timedelta
+from decimal import Decimal
+from importlib import import_module
 
 import pytest
+from asgiref.sync import async_to_sync
 
 from rest_framework.test import APIClient, APITestCase
 from rest_framework import status
+from rest_framework.utils.encoders import JSONEncoder
 
+from django.apps import apps as django_apps
 from django.core.exceptions import ValidationError
-from django.urls import reverse
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.test import AsyncClient
+from django.urls import path, reverse
+from django.utils import timezone
 from django.utils.timezone import make_aware
 
-from debts.models import User, Debt, DebtAccumulate
-from debts.views import create_user_object
+from debts import cache, graph, renderers
+from debts.db import REPLICA, replica_reads
+from debts.cycles import cancel_cycles
+from debts.expiration import process_expired
+from debts.graph import DebtGraph
+from debts.factories import DebtFactory, UserFactory
+from debts.models import (
+    User,
+    AccumulateDelta,
+    Debt,
+    DebtAccumulate,
+    UserBalance,
+    Payment,
+    CycleCancellation,
+    IdempotencyKey,
+    BalanceSnapshot,
+    UserSnapshot,
+    UserObject,
+)
+from debts.schema import schema
+from debts.settlement import net_balances, plan_transfers
+from debts.signals import debts_expired
+from debts.views import (
+    cached_user_objects,
+    create_user_object,
+    create_user_objects,
+    stream_user_objects,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Empty the cache of user objects and the graph of debts, the ids of the users
+    are reused in every test"""
+
+    cache.get_cache().clear()
+    cache.reset_stats()
+    graph.reset()
 
 
 @pytest.fixture
@@ -94,6 +147,257 @@ class TestDebtModel:
         assert acc.total_amount == amount * 2
 
 
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_debts():
+    """Test if concurrent debts for the same pairs don't lose updates"""
+
+    lender = User.objects.create(username="lender")
+    borrowers = [User.objects.create(username=f"borrower{i}") for i in range(2)]
+    date = make_aware(datetime.now() + timedelta(days=20))
+    threads_count = 8
+    debts_per_thread = 250
+    errors = []
+
+    def create_debts(index):
+        try:
+            for i in range(debts_per_thread):
+                Debt(
+                    lender=lender,
+                    borrower=borrowers[(index + i) % 2],
+                    amount=1,
+                    expiration_date=date,
+                ).save()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [
+        threading.Thread(target=create_debts, args=(i,)) for i in range(threads_count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    total = threads_count * debts_per_thread
+    assert Debt.objects.count() == total
+    assert sum(DebtAccumulate.user_debtors(lender).values()) == total
+    assert DebtAccumulate.balance(lender) == total
+    assert UserBalance.verify() == []
+
+
+def test_factories(db):
+    """Test if the factories create debts that update the accumulated debts"""
+
+    lender = UserFactory()
+    debts = DebtFactory.create_batch(3, lender=lender)
+
+    assert lender.has_usable_password() is False
+    assert len(DebtAccumulate.user_debtors(lender)) == 3
+    assert DebtAccumulate.balance(lender) == sum(debt.amount for debt in debts)
+
+
+class TestDebtBulkRecord:
+    """Tests for the creation of many debts at once"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    def test_bulk_record(self, users):
+        """Test if the valid entries are created and the invalid ones reported"""
+
+        values = [
+            ("user1", "user2", 10),
+            ("user1", "user2", 15),
+            ("user2", "user3", 5),
+            ("user1", "user1", 5),
+            ("user1", "nobody", 5),
+            ("user1", "user2", "text"),
+        ]
+        entries = [
+            {
+                "lender": lender,
+                "borrower": borrower,
+                "amount": amount,
+                "expiration_date": self.date,
+            }
+            for lender, borrower, amount in values
+        ]
+        entries.append({"lender": "user1", "borrower": "user2"})
+        debts, errors = Debt.bulk_record(entries)
+
+        assert len(debts) == 3
+        assert [index for index, messages in errors] == [3, 4, 5, 6]
+        assert Debt.objects.count() == 3
+        assert DebtAccumulate.user_debtors(users["user1"]) == {"user2": 25}
+        assert DebtAccumulate.user_debtors(users["user2"]) == {"user3": 5}
+        assert DebtAccumulate.balance(users["user2"]) == -20
+        assert UserBalance.verify() == []
+
+    def test_bulk_record_queries(self, users, django_assert_max_num_queries):
+        """Test if the users are resolved once for all the entries"""
+
+        entries = [
+            {
+                "lender": f"user{i % 4 + 1}",
+                "borrower": f"user{(i + 1) % 4 + 1}",
+                "amount": 1,
+                "expiration_date": self.date,
+            }
+            for i in range(180)
+        ]
+        Debt.bulk_record(entries[:4])
+        # The users, the debts, one update for each of the 4 pairs and 4 users, and
+        # the rebuild marker of the user objects
+        with django_assert_max_num_queries(13):
+            debts, errors = Debt.bulk_record(entries)
+        assert len(debts) == 180
+        assert errors == []
+
+
+def test_iou_bulk(users):
+    """Test the /iou/bulk endpoint"""
+
+    endpoint_url = reverse("iou-bulk")
+
+    client = APIClient()
+
+    # The request must have a list of IOUs
+    response = client.post(path=endpoint_url, data={"ious": "text"}, format="json")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    values = [
+        ("user1", "user2", 50),
+        ("user1", "nobody", 50),
+        ("user3", "user1", 20),
+        (["user1"], "user2", 10),
+    ]
+    data = {
+        "ious": [
+            {
+                "lender": lender,
+                "borrower": borrower,
+                "amount": amount,
+                "expiration": "2022-11-20",
+            }
+            for lender, borrower, amount in values
+        ]
+    }
+    response = client.post(path=endpoint_url, data=data, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["created"] == 2
+    assert response.data["errors"] == [
+        {"index": 1, "errors": ["There is no user nobody"]},
+        {"index": 3, "errors": ["The lender must be a username"]},
+    ]
+    assert response.data["users"] == [
+        {
+            "name": "user1",
+            "owes": {"user3": 20},
+            "owed_by": {"user2": 50},
+            "balance": 30,
+        },
+        {"name": "user2", "owes": {"user1": 50}, "owed_by": {}, "balance": -50},
+        {"name": "user3", "owes": {}, "owed_by": {"user1": 20}, "balance": 20},
+    ]
+
+
+class TestImportDebtsCommand:
+    """Tests for the import_debts command"""
+
+    def test_import_csv(self, users, tmp_path):
+        """Test if the debts are imported, the users created and the totals rebuilt"""
+
+        path = tmp_path / "debts.csv"
+        path.write_text(
+            "lender,borrower,amount,expiration\n"
+            "user1,user2,10,2022-11-20\n"
+            "user1,new_user,20.5,2022-11-21\n"
+            "user1,user1,5,2022-11-21\n"
+            "user2,user1,4,2022-11-22\n"
+        )
+        call_command("import_debts", str(path), "--chunk-size", "2")
+
+        new_user = User.objects.get(username="new_user")
+        assert new_user.has_usable_password() is False
+        assert Debt.objects.count() == 3
+        # The debts of user1 and user2 are netted
+        assert DebtAccumulate.user_debtors(users["user1"]) == {
+            "user2": 6,
+            "new_user": Decimal("20.5"),
+        }
+        assert DebtAccumulate.balance(users["user1"]) == Decimal("26.5")
+        assert UserBalance.verify() == []
+
+    def test_import_ndjson_checkpoint(self, users, tmp_path):
+        """Test if the import resumes from the checkpoint"""
+
+        path = tmp_path / "debts.ndjson"
+        values = [
+            ("user1", "user2", 10),
+            ("user2", "user3", 20),
+            ("user3", "user4", 30),
+        ]
+        lines = [
+            json.dumps(
+                {
+                    "lender": lender,
+                    "borrower": borrower,
+                    "amount": amount,
+                    "expiration": "2022-11-20",
+                }
+            )
+            for lender, borrower, amount in values
+        ]
+        path.write_text("\n".join(lines))
+        checkpoint = tmp_path / "checkpoint"
+        checkpoint.write_text("2")
+
+        call_command("import_debts", str(path), "--checkpoint", str(checkpoint))
+
+        assert checkpoint.read_text() == "3"
+        assert list(Debt.objects.values_list("amount", flat=True)) == [30]
+        assert DebtAccumulate.user_debtors(users["user3"]) == {"user4": 30}
+
+    def test_import_invalid_usernames(self, users, tmp_path):
+        """Test if the rows with users that aren't usernames are invalid"""
+
+        path = tmp_path / "debts.ndjson"
+        values = [(["user1"], "user2", 10), (123, "user2", 20), ("user1", "user2", 30)]
+        lines = [
+            json.dumps(
+                {
+                    "lender": lender,
+                    "borrower": borrower,
+                    "amount": amount,
+                    "expiration": "2022-11-20",
+                }
+            )
+            for lender, borrower, amount in values
+        ]
+        path.write_text("\n".join(lines))
+
+        call_command("import_debts", str(path))
+
+        assert not User.objects.filter(username="123").exists()
+        assert list(Debt.objects.values_list("amount", flat=True)) == [30]
+        assert DebtAccumulate.user_debtors(users["user1"]) == {"user2": 30}
+
+    def test_import_invalid_arguments(self, users, tmp_path):
+        """Test if the chunks of no rows and the negative offsets are rejected"""
+
+        path = tmp_path / "debts.csv"
+        path.write_text(
+            "lender,borrower,amount,expiration\n"
+            "user1,user2,10,2022-11-20\n"
+        )
+        for arguments in (["--chunk-size", "0"], ["--start-at", "-1"]):
+            with pytest.raises(CommandError):
+                call_command("import_debts", str(path), *arguments)
+        assert Debt.objects.count() == 0
+
+
 class TestDebtAccumulateModel:
     """Tests for the DebtAccumulate models"""
 
@@ -202,6 +506,565 @@ class TestDebtAccumulateModel:
         # Test if the balance for a user with no registers is 0
         assert DebtAccumulate.balance(users["user3"]) == 0
 
+    def test_netted_pairs(self, users):
+        """Test if the debts of a pair in both directions are kept in one row"""
+
+        for lender, borrower, amount in [
+            ("user2", "user1", 30),
+            ("user1", "user2", 10),
+            ("user3", "user1", 5),
+        ]:
+            self.debt(
+                lender=users[lender],
+                borrower=users[borrower],
+                amount=amount,
+                expiration_date=self.date,
+            ).save()
+
+        # The lender of the row is the user with the lower id
+        def rows():
+            return list(
+                DebtAccumulate.objects.order_by("borrower_id").values_list(
+                    "lender__username", "borrower__username", "total_amount"
+                )
+            )
+
+        assert rows() == [("user1", "user2", -20), ("user1", "user3", -5)]
+        creditors = {"user2": 20, "user3": 5}
+        assert DebtAccumulate.user_creditors(users["user1"]) == creditors
+        assert DebtAccumulate.user_debtors(users["user1"]) == {}
+        assert DebtAccumulate.user_debtors(users["user2"]) == {"user1": 20}
+        assert create_user_object(users["user2"])["owed_by"] == {"user1": 20}
+
+        # The rebuild gives the same rows and a pair without debts has no row
+        DebtAccumulate.rebuild()
+        assert rows() == [("user1", "user2", -20), ("user1", "user3", -5)]
+        self.debt(
+            lender=users["user1"],
+            borrower=users["user2"],
+            amount=20,
+            expiration_date=self.date,
+        ).save()
+        assert rows() == [("user1", "user3", -5)]
+
+
+class TestWriteBehind:
+    """Tests for the write-behind mode of the accumulated debts"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    @pytest.fixture(autouse=True)
+    def write_behind(self, settings):
+        """Enable the write-behind mode"""
+
+        settings.DEBTS_WRITE_BEHIND = True
+
+    def state(self, users):
+        """Returns the debts and balances of the users from every read"""
+
+        return (
+            [create_user_object(user) for user in users.values()],
+            DebtAccumulate.user_debtors(users["user1"]),
+            DebtAccumulate.user_creditors(users["user1"]),
+            {name: DebtAccumulate.balance(user) for name, user in users.items()},
+            net_balances(),
+        )
+
+    def test_fold(self, users):
+        """Test if the reads add the debts of the log until it is folded"""
+
+        for lender, borrower, amount in [
+            ("user1", "user2", 10),
+            ("user2", "user1", 4),
+            ("user3", "user1", 5),
+        ]:
+            Debt(
+                lender=users[lender],
+                borrower=users[borrower],
+                amount=amount,
+                expiration_date=self.date,
+            ).save()
+        entry = {"lender": "user2", "borrower": "user3", "amount": 2}
+        Debt.bulk_record([{**entry, "expiration_date": self.date}])
+        assert DebtAccumulate.objects.count() == 0
+        assert AccumulateDelta.objects.count() == 4
+
+        state = self.state(users)
+        assert state[0][0] == {
+            "name": "user1",
+            "owes": {"user3": 5},
+            "owed_by": {"user2": 6},
+            "balance": 1,
+        }
+        assert state[1:3] == ({"user2": 6}, {"user3": 5})
+        assert state[3] == {"user1": 1, "user2": -4, "user3": 3, "user4": 0}
+        assert state[4] == {"user1": 1, "user2": -4, "user3": 3}
+
+        out = io.StringIO()
+        call_command("fold_debt_deltas", "--batch-size", "3", stdout=out)
+        assert "Folded 4 debts" in out.getvalue()
+        assert AccumulateDelta.objects.count() == 0
+        assert DebtAccumulate.objects.count() == 3
+        assert self.state(users) == state
+        assert UserBalance.verify() == []
+
+        # A batch without deltas would never end
+        with pytest.raises(ValueError):
+            AccumulateDelta.fold(0)
+        with pytest.raises(CommandError):
+            call_command("fold_debt_deltas", "--batch-size", "0")
+
+    def test_concurrent_fold(self, users):
+        """Test if the deltas deleted by another fold are not added again"""
+
+        for lender, borrower, amount in [("user1", "user2", 10), ("user3", "user1", 5)]:
+            Debt(
+                lender=users[lender],
+                borrower=users[borrower],
+                amount=amount,
+                expiration_date=self.date,
+            ).save()
+
+        # Another fold runs between the read and the delete of the first batch
+        other_fold = {}
+
+        def fold_before_delete(execute, sql, params, many, context):
+            if sql.startswith("DELETE") and "folded" not in other_fold:
+                other_fold["folded"] = None
+                other_fold["folded"] = AccumulateDelta.fold()
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(fold_before_delete):
+            AccumulateDelta.fold()
+        assert other_fold == {"folded": 2}
+        assert AccumulateDelta.objects.count() == 0
+        assert DebtAccumulate.user_debtors(users["user1"]) == {"user2": 10}
+        assert DebtAccumulate.user_creditors(users["user1"]) == {"user3": 5}
+        assert UserBalance.verify() == []
+
+
+class TestUserBalanceModel:
+    """Tests for the UserBalance ledger"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    def test_record(self, users):
+        """Test if saving a debt updates the ledger of the lender and the borrower"""
+
+        Debt(
+            lender=users["user1"],
+            borrower=users["user2"],
+            amount=30,
+            expiration_date=self.date,
+        ).save()
+        Debt(
+            lender=users["user2"],
+            borrower=users["user1"],
+            amount=10,
+            expiration_date=self.date,
+        ).save()
+
+        balance = UserBalance.objects.get(user=users["user1"])
+        assert (balance.credit_total, balance.debit_total, balance.net) == (30, 10, 20)
+        balance = UserBalance.objects.get(user=users["user2"])
+        assert (balance.credit_total, balance.debit_total, balance.net) == (10, 30, -20)
+
+    def test_rebuild_balances_command(self, users):
+        """Test if the command detects and repairs a wrong ledger"""
+
+        Debt(
+            lender=users["user1"],
+            borrower=users["user2"],
+            amount=30,
+            expiration_date=self.date,
+        ).save()
+        UserBalance.objects.filter(user=users["user1"]).update(net=0)
+        UserBalance.objects.filter(user=users["user2"]).delete()
+
+        assert UserBalance.verify() == [users["user1"].id, users["user2"].id]
+        with pytest.raises(CommandError):
+            call_command("rebuild_balances", "--check")
+
+        call_command("rebuild_balances")
+        assert UserBalance.verify() == []
+        assert DebtAccumulate.balance(users["user1"]) == 30
+        assert DebtAccumulate.balance(users["user2"]) == -30
+
+
+class TestPaymentModel:
+    """Tests for the Payment model"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    def totals(self):
+        """Returns the accumulated debts by (lender, borrower) username"""
+
+        totals = {}
+        for row in DebtAccumulate.objects.select_related("lender", "borrower"):
+            if row.total_amount > 0:
+                totals[(row.lender.username, row.borrower.username)] = row.total_amount
+            else:
+                totals[(row.borrower.username, row.lender.username)] = -row.total_amount
+        return totals
+
+    def test_pay(self, users):
+        """Test if the payments net the debts of the pair in both directions"""
+
+        for lender, borrower, amount in [
+            ("user1", "user2", 30),
+            ("user2", "user1", 10),
+        ]:
+            Debt(
+                lender=users[lender],
+                borrower=users[borrower],
+                amount=amount,
+                expiration_date=self.date,
+            ).save()
+
+        # The pair is netted and the payment subtracted
+        Payment(payer=users["user2"], payee=users["user1"], amount=5).save()
+        assert self.totals() == {("user1", "user2"): 15}
+
+        # A payment larger than the debt leaves a debt in the other direction
+        Payment(payer=users["user2"], payee=users["user1"], amount=20).save()
+        assert self.totals() == {("user2", "user1"): 5}
+
+        # A paid off pair has no rows
+        Payment(payer=users["user1"], payee=users["user2"], amount=5).save()
+        assert self.totals() == {}
+        assert create_user_object(users["user1"]) == {
+            "name": "user1",
+            "owes": {},
+            "owed_by": {},
+            "balance": 0,
+        }
+
+        balance = UserBalance.objects.get(user=users["user2"])
+        assert balance.totals() == (10, 30, 25, 5, 0)
+        assert UserBalance.verify() == []
+
+        # The rebuild nets the pairs with payments
+        Debt(
+            lender=users["user1"],
+            borrower=users["user3"],
+            amount=7,
+            expiration_date=self.date,
+        ).save()
+        Payment(payer=users["user3"], payee=users["user4"], amount=2).save()
+        totals = self.totals()
+        DebtAccumulate.rebuild()
+        assert self.totals() == totals == {
+            ("user1", "user3"): 7,
+            ("user3", "user4"): 2,
+        }
+
+    def test_invalid_payments(self, users):
+        """Test if the payments to oneself and without a positive amount fail"""
+
+        for payer, amount in [("user1", 10), ("user2", 0), ("user2", -1)]:
+            with pytest.raises(ValidationError):
+                Payment(payer=users[payer], payee=users["user1"], amount=amount).save()
+        assert Payment.objects.count() == 0
+        assert UserBalance.objects.count() == 0
+
+
+class TestBalanceSnapshot:
+    """Tests for the snapshots of the balances"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+    start = make_aware(datetime(2026, 1, 1))
+
+    def create_debt(self, lender, borrower, amount, hours):
+        """Save a debt created some hours after the start"""
+
+        Debt(
+            lender=lender,
+            borrower=borrower,
+            amount=amount,
+            expiration_date=self.date,
+            created_at=self.start + timedelta(hours=hours),
+        ).save()
+
+    def test_balance_as_of(self, users, django_assert_num_queries):
+        """Test if the balances at a time add the debts created after the snapshot"""
+
+        self.create_debt(users["user1"], users["user2"], Decimal("10.50"), 1)
+        self.create_debt(users["user2"], users["user1"], 4, 2)
+        self.create_debt(users["user3"], users["user1"], 3, 5)
+        snapshot = BalanceSnapshot.take(self.start + timedelta(hours=3))
+        assert snapshot.users.count() == 2
+        self.create_debt(users["user1"], users["user2"], 1, 4)
+
+        # The next snapshot is taken from the previous one
+        later = BalanceSnapshot.take(self.start + timedelta(hours=4))
+        entry = later.users.get(user=users["user1"])
+        assert entry.owed_by == {str(users["user2"].id): 750}
+        assert entry.owes == {}
+        assert entry.balance == Decimal("7.50")
+
+        at = self.start + timedelta(hours=6)
+        with django_assert_num_queries(5):
+            result = BalanceSnapshot.balance_as_of(users["user1"], at)
+        assert result == {
+            "owes": {"user3": 3},
+            "owed_by": {"user2": Decimal("7.50")},
+            "balance": Decimal("4.50"),
+        }
+
+        # The debts are the same without snapshots and before them
+        assert BalanceSnapshot.balance_as_of(users["user1"], at) == result
+        BalanceSnapshot.objects.all().delete()
+        assert BalanceSnapshot.balance_as_of(users["user1"], at) == result
+        before = BalanceSnapshot.balance_as_of(
+            users["user1"], self.start + timedelta(hours=1)
+        )
+        assert before == {
+            "owes": {},
+            "owed_by": {"user2": Decimal("10.50")},
+            "balance": Decimal("10.50"),
+        }
+
+        # The payments net the pair
+        Payment(
+            payer=users["user2"],
+            payee=users["user1"],
+            amount=10,
+            created_at=self.start + timedelta(hours=7),
+        ).save()
+        at = self.start + timedelta(hours=8)
+        result = {
+            "owes": {"user2": Decimal("2.50"), "user3": 3},
+            "owed_by": {},
+            "balance": Decimal("-5.50"),
+        }
+        assert BalanceSnapshot.balance_as_of(users["user1"], at) == result
+        BalanceSnapshot.take(at)
+        assert BalanceSnapshot.balance_as_of(users["user1"], at) == result
+
+    def test_snapshot_balances_command(self, users):
+        """Test if the command takes the snapshots and compacts them"""
+
+        self.create_debt(users["user1"], users["user2"], 10, 1)
+        for hours in [2, 3, 26, 27, 50]:
+            as_of = (self.start + timedelta(hours=hours)).isoformat()
+            call_command("snapshot_balances", "--as-of", as_of, stdout=io.StringIO())
+        assert BalanceSnapshot.objects.count() == 5
+
+        # The newest snapshot and the last one of every day are kept
+        call_command(
+            "snapshot_balances", "--no-snapshot", "--keep", "1", stdout=io.StringIO()
+        )
+        taken = BalanceSnapshot.objects.values_list("taken_at", flat=True)
+        assert [time.hour for time in taken] == [2, 3, 3]
+        assert UserSnapshot.objects.count() == 6
+
+        with pytest.raises(CommandError):
+            call_command("snapshot_balances", "--as-of", "yesterday")
+
+
+class TestCreateUserObjects:
+    """Tests for the batch creation of user objects"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    def create_debts(self, users):
+        """Create debts between all the users in both directions"""
+
+        amount = 10
+        for lender in users.values():
+            for borrower in users.values():
+                if lender != borrower:
+                    Debt(
+                        lender=lender,
+                        borrower=borrower,
+                        amount=amount,
+                        expiration_date=self.date,
+                    ).save()
+                    amount += 5
+
+    def test_same_as_accumulate_methods(self, users):
+        """Test if the batch objects are the ones of the DebtAccumulate methods"""
+
+        self.create_debts(users)
+        expected = [
+            {
+                "name": user.username,
+                "owes": DebtAccumulate.user_creditors(user),
+                "owed_by": DebtAccumulate.user_debtors(user),
+                "balance": DebtAccumulate.balance(user),
+            }
+            for user in users.values()
+        ]
+
+        assert create_user_objects(list(users.values())) == expected
+        assert create_user_objects(User.objects.order_by("id")) == expected
+
+    def test_settleup_queries(self, users, django_assert_num_queries):
+        """Test if /settleup uses the same number of queries for any number of users"""
+
+        self.create_debts(users)
+        User.objects.bulk_create(User(username=f"extra{i}") for i in range(20))
+
+        client = APIClient()
+        # One query for the users and one for the accumulated debts
+        with django_assert_num_queries(2):
+            response = client.get(
+                path=reverse("settleup"), data={"page_size": 30}, format="json"
+            )
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data["results"]) == 24
+
+    def test_materialized_user_objects(
+        self, users, settings, django_assert_num_queries
+    ):
+        """Test if the user objects are read from the UserObject rows"""
+
+        settings.DEBTS_USER_OBJECTS = True
+        self.create_debts(users)
+        # The debts between user1 and user2 are paid
+        Payment(payer=users["user2"], payee=users["user1"], amount=5).save()
+        entry = {"lender": "user3", "borrower": "user4", "amount": 1}
+        Debt.bulk_record([{**entry, "expiration_date": self.date}])
+        expected = [
+            {
+                "name": user.username,
+                "owes": DebtAccumulate.user_creditors(user),
+                "owed_by": DebtAccumulate.user_debtors(user),
+                "balance": DebtAccumulate.balance(user),
+            }
+            for user in users.values()
+        ]
+        assert "user2" not in expected[0]["owed_by"]
+
+        # One query for the rebuild marker and one for the row
+        with django_assert_num_queries(2):
+            assert create_user_object(users["user1"]) == expected[0]
+        assert create_user_objects(User.objects.order_by("id")) == expected
+        assert UserObject.verify() == []
+
+        # The rows of a renamed user are wrong until they are rebuilt
+        User.objects.filter(pk=users["user1"].pk).update(username="renamed")
+        with pytest.raises(CommandError):
+            call_command("check_user_objects")
+        out = io.StringIO()
+        call_command("check_user_objects", "--rebuild", stdout=out)
+        assert "The user objects match the debts" in out.getvalue()
+        assert "renamed" in create_user_object(users["user2"])["owed_by"]
+
+    def test_incomplete_user_objects(self, users, settings):
+        """Test if the rows are only read while they have the debts of every user"""
+
+        def owe(lender, borrower, amount):
+            Debt(
+                lender=users[lender],
+                borrower=users[borrower],
+                amount=amount,
+                expiration_date=self.date,
+            ).save()
+
+        # The migration fills the rows and marks them as complete
+        migration = import_module("debts.migrations.0012_user_objects_rebuild")
+        owe("user1", "user2", 10)
+        migration.populate_user_objects(django_apps, None)
+        assert UserObject.complete()
+        assert UserObject.verify() == []
+
+        # A debt without the setting doesn't update the rows
+        owe("user1", "user3", 20)
+        assert not UserObject.complete()
+
+        settings.DEBTS_USER_OBJECTS = True
+        owe("user1", "user4", 5)
+        user_object = create_user_object(users["user1"])
+        assert user_object["owed_by"] == {"user2": 10, "user3": 20, "user4": 5}
+        assert user_object["balance"] == 35
+
+        call_command("check_user_objects", "--rebuild", stdout=io.StringIO())
+        assert UserObject.complete()
+        assert create_user_object(users["user1"]) == user_object
+
+
+class TestPlanTransfers:
+    """Tests for the settlement planner"""
+
+    def settle(self, balances, transfers):
+        """Return the balances after the transfers"""
+
+        balances = dict(balances)
+        for debtor, creditor, amount in transfers:
+            balances[debtor] += amount
+            balances[creditor] -= amount
+        return balances
+
+    def test_exact(self):
+        """Test if the exact plan finds the groups that settle between them"""
+
+        balances = {"a": 10, "b": -10, "c": 30, "d": -20, "e": -10}
+        transfers = plan_transfers(balances, exact=True)
+
+        assert len(transfers) == 3
+        assert ("b", "a", 10) in transfers
+        assert set(self.settle(balances, transfers).values()) == {0}
+
+    def test_greedy(self):
+        """Test if the greedy plan settles the balances in at most n - 1 transfers"""
+
+        balances = {f"user{i}": Decimal(i * 7 % 50) - 20 for i in range(40)}
+        balances["user0"] -= sum(balances.values())
+        transfers = plan_transfers(balances, exact=False)
+
+        assert len(transfers) < len(balances)
+        assert set(self.settle(balances, transfers).values()) == {0}
+
+    def test_invalid(self):
+        """Test if balances that don't sum zero raise a ValueError"""
+
+        with pytest.raises(ValueError):
+            plan_transfers({"a": 10, "b": -5})
+
+
+def test_settleup_plan(users):
+    """Test the /settleup/plan endpoint"""
+
+    endpoint_url = reverse("settleup-plan")
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    client = APIClient()
+
+    # A cycle of debts doesn't need transfers
+    cycle = [("user1", "user2"), ("user2", "user3"), ("user3", "user1")]
+    for lender, borrower in cycle:
+        Debt(
+            lender=users[lender],
+            borrower=users[borrower],
+            amount=20,
+            expiration_date=date,
+        ).save()
+    Debt(
+        lender=users["user1"],
+        borrower=users["user4"],
+        amount=5,
+        expiration_date=date,
+    ).save()
+
+    response = client.get(path=endpoint_url, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data == {
+        "transfers": [{"from": "user4", "to": "user1", "amount": Decimal("5.00")}]
+    }
+
+    # Only the debts between the users are settled
+    response = client.get(
+        path=endpoint_url, data={"users": "user1,user2", "mode": "greedy"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data == {
+        "transfers": [{"from": "user2", "to": "user1", "amount": Decimal("20.00")}]
+    }
+
+    response = client.get(path=endpoint_url, data={"mode": "text"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
 
 def test_settleup(users):
     """Test the /settleup endpoint"""
@@ -211,13 +1074,14 @@ def test_settleup(users):
 
     client = APIClient()
 
-    # Test if the endpoint returns all the user objects if there is no data
+    # Test if the endpoint returns a page with all the user objects without data
     response = client.get(path=endpoint_url, format="json")
     data = []
     for user in users.values():
         data.append(create_user_object(user))
     assert response.status_code == status.HTTP_200_OK
-    assert response.data == data
+    assert response.data["results"] == data
+    assert response.data["next"] is None
 
     amount = 20
     # Test if the endpoint returns the appropiate data
@@ -252,6 +1116,380 @@ def test_settleup(users):
     assert response.data == data
 
 
+def test_settleup_cache(users, django_capture_on_commit_callbacks):
+    """Test if the cached user objects are never stale after an IOU"""
+
+    endpoint_url = reverse("settleup")
+    params = {"users": "user1,user2"}
+
+    client = APIClient()
+    response = client.get(path=endpoint_url, data=params)
+    assert cache.stats() == {"hits": 0, "misses": 2}
+    response = client.get(path=endpoint_url, data=params)
+    assert cache.stats() == {"hits": 2, "misses": 2}
+    assert response.data[0]["owed_by"] == {}
+
+    data = {
+        "lender": "user1",
+        "borrower": "user2",
+        "amount": 50,
+        "expiration": "2022-11-20",
+    }
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(path=reverse("iou"), data=data, format="json")
+
+    response = client.get(path=endpoint_url, data=params)
+    assert response.data == create_user_objects([users["user1"], users["user2"]])
+    assert response.data[0]["owed_by"] == {"user2": 50}
+
+    # The users of other pairs stay in the cache
+    client.get(path=endpoint_url, data={"users": "user3"})
+    cache.reset_stats()
+    client.get(path=endpoint_url, data={"users": "user1,user2,user3"})
+    assert cache.stats() == {"hits": 3, "misses": 0}
+
+
+def test_settleup_cache_race(users, django_capture_on_commit_callbacks):
+    """Test if a user object created before the commit of an IOU and saved after it
+    isn't returned from the cache"""
+
+    user_ids = [users["user1"].pk, users["user2"].pk]
+    user_objects, versions = cache.get_user_objects(user_ids)
+    assert user_objects == {}
+    stale = dict(zip(user_ids, create_user_objects([users["user1"], users["user2"]])))
+
+    data = {
+        "lender": "user1",
+        "borrower": "user2",
+        "amount": 50,
+        "expiration": "2022-11-20",
+    }
+    client = APIClient()
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(path=reverse("iou"), data=data, format="json")
+
+    cache.set_user_objects(stale, versions)
+    assert cache.get_user_objects(user_ids)[0] == {}
+
+    response = client.get(path=reverse("settleup"), data={"users": "user1,user2"})
+    assert response.data[0]["owed_by"] == {"user2": 50}
+
+
+def test_settleup_pages(users):
+    """Test if the pages of /settleup follow the usernames"""
+
+    endpoint_url = reverse("settleup")
+    User.objects.bulk_create(User(username=f"extra{i:02}") for i in range(21))
+    names = sorted(User.objects.values_list("username", flat=True))
+
+    client = APIClient()
+    received = []
+    url = endpoint_url + "?page_size=10"
+    while url:
+        response = client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        received.extend(user_object["name"] for user_object in response.data["results"])
+        url = response.data["next"]
+    assert received == names
+
+    # The default page size is the one of the settings
+    response = client.get(path=endpoint_url)
+    assert len(response.data["results"]) == 20
+
+
+def test_settleup_stream(users):
+    """Test the streaming of /settleup as NDJSON"""
+
+    endpoint_url = reverse("settleup")
+    date = make_aware(datetime.now() + timedelta(days=20))
+    Debt(
+        lender=users["user1"],
+        borrower=users["user2"],
+        amount=20,
+        expiration_date=date,
+    ).save()
+    data = [
+        json.loads(json.dumps(user_object, cls=JSONEncoder))
+        for user_object in create_user_objects(User.objects.order_by("id"))
+    ]
+
+    # The user objects are the same in chunks of any size
+    lines = stream_user_objects(User.objects.order_by("id"), chunk_size=3)
+    assert [json.loads(line) for line in lines] == data
+
+    client = APIClient()
+    for response in [
+        client.get(path=endpoint_url, data={"stream": "1"}),
+        client.get(path=endpoint_url, HTTP_ACCEPT="application/x-ndjson"),
+    ]:
+        assert response.status_code == status.HTTP_200_OK
+        assert response["Content-Type"] == "application/x-ndjson"
+        content = b"".join(response.streaming_content).decode()
+        assert [json.loads(line) for line in content.splitlines()] == data
+
+
+def test_settleup_compact(users, monkeypatch):
+    """Test the user objects of /settleup in the compact format"""
+
+    endpoint_url = reverse("settleup")
+    date = make_aware(datetime.now() + timedelta(days=20))
+    Debt(
+        lender=users["user1"],
+        borrower=users["user2"],
+        amount=Decimal("20.50"),
+        expiration_date=date,
+    ).save()
+
+    client = APIClient()
+    response = client.get(
+        path=endpoint_url, data={"users": "user1,user2", "format": "compact"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response["Content-Type"] == "application/json"
+    assert json.loads(response.content) == [
+        {
+            "name": "user1",
+            "owes": {},
+            "owed_by": {"user2": "20.50"},
+            "balance": "20.50",
+        },
+        {
+            "name": "user2",
+            "owes": {"user1": "20.50"},
+            "owed_by": {},
+            "balance": "-20.50",
+        },
+    ]
+
+    cents = {"format": "compact", "amounts": "cents"}
+    response = client.get(path=endpoint_url, data=cents)
+    assert response.status_code == status.HTTP_200_OK
+    data = json.loads(response.content)
+    assert data["results"][0] == {
+        "name": "user1",
+        "owes": {},
+        "owed_by": {"user2": 2050},
+        "balance": 2050,
+    }
+
+    # Without orjson the json module renders the same content
+    monkeypatch.setattr(renderers, "orjson", None)
+    assert client.get(path=endpoint_url, data=cents).content == response.content
+
+
+@pytest.fixture
+def replica(db, tmp_path, settings):
+    """Returns the alias of a replica database in a SQLite file"""
+
+    settings.DEBTS_SQLITE_PRAGMAS = {"journal_mode": "WAL", "synchronous": "NORMAL"}
+    connections.settings[REPLICA] = {
+        **connections.settings["default"],
+        "NAME": str(tmp_path / "replica.sqlite3"),
+    }
+    call_command("migrate", database=REPLICA, verbosity=0)
+    yield REPLICA
+    connections[REPLICA].close()
+    del connections[REPLICA]
+    del connections.settings[REPLICA]
+
+
+def test_replica(users, replica):
+    """Test if /settleup and the GraphQL queries read from the replica"""
+
+    with connections[replica].cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        assert cursor.fetchone()[0] == "wal"
+    User.objects.using(replica).create(username="replicated")
+
+    client = APIClient()
+    response = client.get(path=reverse("settleup"), format="json")
+    assert [user["name"] for user in response.data["results"]] == ["replicated"]
+    response = client.get(path=reverse("settleup"), data={"stream": "1"})
+    assert b"replicated" in b"".join(response.streaming_content)
+
+    # The debts are written to the primary database
+    data = {
+        "lender": "user1",
+        "borrower": "user2",
+        "amount": 50,
+        "expiration": "2022-11-20",
+    }
+    response = client.post(path=reverse("iou"), data=data, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    assert Debt.objects.count() == 1
+    assert Debt.objects.using(replica).count() == 0
+
+    query = '{ expiredDebts(datetime: "2023-01-01T00:00:00+00:00") { amount } }'
+    response = client.post("/expired_iou", {"query": query}, format="json")
+    assert response.json() == {"data": {"expiredDebts": []}}
+
+
+def test_replica_shared_state(users, replica, django_capture_on_commit_callbacks):
+    """Test if what is read from a replica behind the primary isn't cached"""
+
+    User.objects.using(replica).bulk_create(
+        User(id=user.id, username=user.username) for user in users.values()
+    )
+    graph.reset()
+    graph.read(len)
+
+    data = {
+        "lender": "user1",
+        "borrower": "user2",
+        "amount": 50,
+        "expiration": "2022-11-20",
+    }
+    client = APIClient()
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(path=reverse("iou"), data=data, format="json")
+
+    # The replica doesn't have the debt yet
+    response = client.get(path=reverse("settleup"), data={"users": "user1,user2"})
+    assert response.data[0]["owed_by"] == {}
+    user_ids = [users["user1"].pk, users["user2"].pk]
+    assert cache.get_user_objects(user_ids)[0] == {}
+    assert cached_user_objects([users["user1"]])[0]["owed_by"] == {"user2": 50}
+
+    # The changed pairs of the graph are read from the primary
+    with replica_reads():
+        edges = graph.read(lambda debts: list(debts.edges()))
+    assert edges == [(users["user2"].pk, users["user1"].pk, 5000)]
+
+
+def test_timing_middleware(users, settings, tmp_path, caplog):
+    """Test the measures of the queries and the time of the requests"""
+
+    endpoint_url = reverse("settleup")
+    settings.DEBTS_PROFILE_DIR = tmp_path
+
+    client = APIClient()
+    with caplog.at_level("INFO", logger="debts.timing"):
+        response = client.get(path=endpoint_url, data={"users": "user1,user2"})
+    assert response.status_code == status.HTTP_200_OK
+    metrics = [metric.split(";")[0] for metric in response["Server-Timing"].split(", ")]
+    assert metrics == ["db", "view", "render", "total"]
+
+    timing = caplog.records[-1].timing
+    assert json.loads(caplog.records[-1].getMessage()) == timing
+    assert timing["view"] == "settleup"
+    assert timing["status"] == 200
+    assert timing["queries"] >= 2
+    assert f'desc="{timing["queries"]} queries"' in response["Server-Timing"]
+    assert timing["slowest_sql"].startswith("SELECT")
+    assert timing["db_ms"] <= timing["view_ms"] <= timing["total_ms"]
+    assert "profile" not in timing
+    assert not list(tmp_path.iterdir())
+
+    # The profile is saved only for the requests slower than the threshold
+    settings.DEBTS_PROFILE_THRESHOLD_MS = 60_000
+    client.get(path=endpoint_url)
+    assert not list(tmp_path.iterdir())
+
+    settings.DEBTS_PROFILE_THRESHOLD_MS = 0
+    with caplog.at_level("INFO", logger="debts.timing"):
+        client.get(path=endpoint_url)
+    profiles = list(tmp_path.iterdir())
+    assert len(profiles) == 1
+    assert caplog.records[-1].timing["profile"] == str(profiles[0])
+    assert pstats.Stats(str(profiles[0])).total_calls > 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_timing_middleware_async_queries(caplog):
+    """Test if the queries of the async views are measured"""
+
+    for username in ["user1", "user2"]:
+        User.objects.create(username=username)
+    client = AsyncClient()
+
+    @async_to_sync
+    async def get(*args, **kwargs):
+        return await client.get(*args, **kwargs)
+
+    with caplog.at_level("INFO", logger="debts.timing"):
+        response = get(reverse("async-settleup") + "?users=user1,user2")
+    assert response.status_code == status.HTTP_200_OK
+
+    timing = caplog.records[-1].timing
+    assert timing["view"] == "async-settleup"
+    assert timing["queries"] >= 2
+    assert timing["slowest_sql"].startswith("SELECT")
+    assert f'desc="{timing["queries"]} queries"' in response["Server-Timing"]
+
+
+async def slow_view(request):
+    """Return an empty response after a pause, without using the database"""
+
+    await asyncio.sleep(0.2)
+    return HttpResponse()
+
+
+urlpatterns = [path("slow", slow_view)]
+
+
+@pytest.mark.urls("debts.tests")
+def test_timing_middleware_async():
+    """Test that the middleware doesn't serialize the async requests"""
+
+    client = AsyncClient()
+
+    @async_to_sync
+    async def get_concurrently(count):
+        return await asyncio.gather(*(client.get("/slow") for _ in range(count)))
+
+    start = time.perf_counter()
+    responses = get_concurrently(10)
+    elapsed = time.perf_counter() - start
+
+    assert all(response.status_code == 200 for response in responses)
+    assert all("total;dur=" in response["Server-Timing"] for response in responses)
+    # Ten pauses of 0.2 seconds one after the other would take 2 seconds
+    assert elapsed < 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_views():
+    """Test the async endpoints"""
+
+    client = AsyncClient()
+
+    @async_to_sync
+    async def get(*args, **kwargs):
+        return await client.get(*args, **kwargs)
+
+    @async_to_sync
+    async def post(*args, **kwargs):
+        return await client.post(*args, **kwargs)
+
+    for username in ["user1", "user2"]:
+        response = post(
+            reverse("async-add"), {"user": username}, content_type="application/json"
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["name"] == username
+
+    data = {
+        "lender": "user1",
+        "borrower": "user2",
+        "amount": 50,
+        "expiration": "2022-11-20",
+    }
+    response = post(reverse("async-iou"), data, content_type="application/json")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["users"][0]["owed_by"] == {"user2": 50.0}
+
+    # The same user objects as the synchronous view
+    users = User.objects.order_by("username")
+    response = get(reverse("async-settleup") + "?users=user1,user2")
+    assert response.json() == json.loads(
+        json.dumps(create_user_objects(users), cls=JSONEncoder)
+    )
+
+    response = get(reverse("async-settleup"))
+    assert response.json()["next"] is None
+    assert [item["name"] for item in response.json()["results"]] == ["user1", "user2"]
+
+
 def test_add(db):
     """Test the /add endpoint"""
 
@@ -322,3 +1560,503 @@ def test_iou(db, users):
     response = client.post(path=endpoint_url, data=data, format="json")
     assert response.status_code == status.HTTP_200_OK
     assert response.data == response_data
+
+
+def test_iou_queries(users, django_assert_num_queries):
+    """Test the validation and the queries of an IOU between users with debts"""
+
+    endpoint_url = reverse("iou")
+    client = APIClient()
+    data = {
+        "lender": "user1",
+        "borrower": "user1",
+        "amount": 50,
+        "expiration": "2022-11-20",
+    }
+
+    # The same user and an amount with too many decimals are rejected
+    response = client.post(path=endpoint_url, data=data, format="json")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.data == ["Lender and borrower can't be the same"]
+    data["borrower"] = "user2"
+    data["amount"] = 0.125
+    response = client.post(path=endpoint_url, data=data, format="json")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert Debt.objects.count() == 0
+
+    data["amount"] = 20.5
+    client.post(path=endpoint_url, data=data, format="json")
+
+    # The savepoint of the transaction in the test, the users, the debt, the
+    # updates of the pair and the balances of the users, the rebuild marker of
+    # the user objects and the user objects
+    with django_assert_num_queries(9):
+        response = client.post(path=endpoint_url, data=data, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["users"][0] == {
+        "name": "user1",
+        "owes": {},
+        "owed_by": {"user2": 41},
+        "balance": 41,
+    }
+
+
+def test_iou_idempotency_key(users, settings, django_assert_num_queries):
+    """Test if a request with a used Idempotency-Key returns the saved response"""
+
+    endpoint_url = reverse("iou")
+    client = APIClient()
+    data = {
+        "lender": "user1",
+        "borrower": "user2",
+        "amount": 50,
+        "expiration": "2022-11-20",
+    }
+    response = client.post(
+        path=endpoint_url, data=data, format="json", HTTP_IDEMPOTENCY_KEY="key1"
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["users"][1] == {
+        "name": "user2",
+        "owes": {"user1": 50},
+        "owed_by": {},
+        "balance": -50,
+    }
+
+    # The savepoint of the transaction and the key, without writes
+    with django_assert_num_queries(3):
+        replay = client.post(
+            path=endpoint_url, data=data, format="json", HTTP_IDEMPOTENCY_KEY="key1"
+        )
+    assert replay.data == response.data
+    assert Debt.objects.count() == 1
+    assert DebtAccumulate.objects.get().total_amount == 50
+
+    data["amount"] = 20
+    response = client.post(
+        path=endpoint_url, data=data, format="json", HTTP_IDEMPOTENCY_KEY="key1"
+    )
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.post(
+        path=endpoint_url, data=data, format="json", HTTP_IDEMPOTENCY_KEY="key2"
+    )
+    assert response.data["users"][0]["owed_by"] == {"user2": 70}
+
+    # The expired keys are used again and deleted
+    out = io.StringIO()
+    call_command("purge_idempotency_keys", stdout=out)
+    assert "Deleted 0 expired keys" in out.getvalue()
+    settings.DEBTS_IDEMPOTENCY_TIMEOUT = 0
+    response = client.post(
+        path=endpoint_url, data=data, format="json", HTTP_IDEMPOTENCY_KEY="key1"
+    )
+    assert response.data["users"][0]["owed_by"] == {"user2": 90}
+    call_command("purge_idempotency_keys", stdout=out)
+    assert "Deleted 2 expired keys" in out.getvalue()
+    assert IdempotencyKey.objects.count() == 0
+
+
+def test_pay(users):
+    """Test the /pay endpoint"""
+
+    endpoint_url = reverse("pay")
+    date = make_aware(datetime.now() + timedelta(days=20))
+    Debt(
+        lender=users["user1"],
+        borrower=users["user2"],
+        amount=50,
+        expiration_date=date,
+    ).save()
+
+    client = APIClient()
+    for data in [
+        {"payer": "user2", "payee": "user1"},
+        {"payer": "user2", "payee": "user_no_existent", "amount": 10},
+        {"payer": "user2", "payee": "user2", "amount": 10},
+        {"payer": "user2", "payee": "user1", "amount": 0},
+    ]:
+        response = client.post(path=endpoint_url, data=data, format="json")
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    data = {"payer": "user2", "payee": "user1", "amount": "20.50"}
+    response = client.post(path=endpoint_url, data=data, format="json")
+    assert response.status_code == status.HTTP_200_OK
+    owed = Decimal("29.50")
+    assert response.data == {
+        "users": [
+            {"name": "user2", "owes": {"user1": owed}, "owed_by": {}, "balance": -owed},
+            {"name": "user1", "owes": {}, "owed_by": {"user2": owed}, "balance": owed},
+        ]
+    }
+
+
+class TestExpiredDebtsQuery:
+    """Tests for the expired debts in the GraphQL api"""
+
+    date = make_aware(datetime(2022, 11, 20))
+
+    def create_debts(self, users):
+        """Create 5 expired debts and a debt that is not expired"""
+
+        for i in range(6):
+            Debt(
+                lender=users["user1"],
+                borrower=users["user2"],
+                amount=i + 1,
+                expiration_date=self.date + timedelta(days=i % 3),
+            ).save()
+
+    def test_expired_debts(self, users, django_assert_num_queries):
+        """Test if the lenders and borrowers are read with the debts"""
+
+        self.create_debts(users)
+        query = """
+            query ($datetime: DateTime) {
+                expiredDebts(datetime: $datetime) {
+                    amount
+                    lender { username }
+                    borrower { username }
+                }
+            }
+        """
+        variables = {"datetime": (self.date + timedelta(days=2)).isoformat()}
+        with django_assert_num_queries(1):
+            result = schema.execute(query, variables=variables)
+
+        assert result.errors is None
+        assert len(result.data["expiredDebts"]) == 4
+        assert result.data["expiredDebts"][0]["lender"] == {"username": "user1"}
+
+    def test_expired_debts_connection(self, users):
+        """Test if the pages of the connection have all the expired debts in order"""
+
+        self.create_debts(users)
+        query = """
+            query ($datetime: DateTime!, $after: String) {
+                expiredDebtsConnection(datetime: $datetime, first: 3, after: $after) {
+                    edges { node { amount borrower { username } } }
+                    pageInfo { hasNextPage endCursor }
+                }
+            }
+        """
+        variables = {"datetime": (self.date + timedelta(days=2)).isoformat()}
+        amounts = []
+        while True:
+            result = schema.execute(query, variables=variables)
+            assert result.errors is None
+            connection = result.data["expiredDebtsConnection"]
+            amounts.extend(edge["node"]["amount"] for edge in connection["edges"])
+            if not connection["pageInfo"]["hasNextPage"]:
+                break
+            variables["after"] = connection["pageInfo"]["endCursor"]
+
+        assert amounts == ["5.00", "2.00", "4.00", "1.00"]
+
+        result = schema.execute(
+            query, variables={"datetime": variables["datetime"], "after": "text"}
+        )
+        assert result.errors[0].message == "Invalid cursor"
+
+    def test_expiring_debts(self, users):
+        """Test if the debts that expire in the following hours are returned in order"""
+
+        now = make_aware(datetime.now())
+        for amount, hours in ((1, 30), (2, 1), (3, -1), (4, 20)):
+            Debt(
+                lender=users["user1"],
+                borrower=users["user2"],
+                amount=amount,
+                expiration_date=now + timedelta(hours=hours),
+            ).save()
+
+        query = """
+            query ($hours: Float) {
+                expiringDebts(hours: $hours) { amount lender { username } }
+            }
+        """
+        result = schema.execute(query)
+        assert result.errors is None
+        assert [debt["amount"] for debt in result.data["expiringDebts"]] == [
+            "2.00",
+            "4.00",
+        ]
+        result = schema.execute(query, variables={"hours": 48})
+        assert [debt["amount"] for debt in result.data["expiringDebts"]] == [
+            "2.00",
+            "4.00",
+            "1.00",
+        ]
+        result = schema.execute(query, variables={"hours": 0})
+        assert result.errors[0].message == "hours must be positive"
+
+
+class TestDebtGraph:
+    """Tests for the graph of debts"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    def test_graph(self):
+        """Test the neighbourhoods, the components and the cycles"""
+
+        debts = DebtGraph()
+        # A cycle 1 -> 2 -> 3 -> 1, a debt 3 -> 4 and a pair 5 -> 6
+        for debtor, creditor, cents in [
+            (1, 2, 500),
+            (2, 3, 300),
+            (3, 1, 200),
+            (3, 4, 100),
+            (5, 6, 50),
+        ]:
+            debts.set_pair(debtor, creditor, cents)
+
+        assert debts.neighbourhood(1, 1) == {2: 1, 3: 1}
+        assert debts.neighbourhood(1, 2) == {2: 1, 3: 1, 4: 2}
+        assert debts.neighbourhood(7, 2) == {}
+        assert [sorted(ids) for ids in debts.components()] == [[1, 2, 3, 4], [5, 6]]
+
+        components = debts.strongly_connected_components()
+        assert [sorted(debts.user_ids(nodes)) for nodes in components] == [[1, 2, 3]]
+        assert list(debts.cycles()) == [[(1, 2, 500), (2, 3, 300), (3, 1, 200)]]
+        assert list(debts.cycles(4)) == []
+
+        # Reversing a debt breaks the cycle
+        debts.set_pair(3, 1, -200)
+        assert list(debts.cycles()) == []
+        assert sorted(debts.edges()) == [
+            (1, 2, 500),
+            (1, 3, 200),
+            (2, 3, 300),
+            (3, 4, 100),
+            (5, 6, 50),
+        ]
+
+    def test_graph_queries(self, users, django_capture_on_commit_callbacks):
+        """Test the graph fields of the GraphQL api and their updates"""
+
+        def save(lender, borrower, amount):
+            with django_capture_on_commit_callbacks(execute=True):
+                Debt(
+                    lender=users[lender],
+                    borrower=users[borrower],
+                    amount=amount,
+                    expiration_date=self.date,
+                ).save()
+
+        save("user2", "user1", 5)
+        save("user3", "user2", 3)
+        query = """
+            query ($username: String) {
+                debtNeighbours(username: "user1", hops: 2) {
+                    user { username }
+                    hops
+                }
+                debtComponents { size users { username } }
+                debtCycles(username: $username) {
+                    amount
+                    debts { lender { username } borrower { username } amount }
+                }
+            }
+        """
+        result = schema.execute(query, variables={"username": "user1"})
+        assert result.errors is None
+        assert result.data["debtNeighbours"] == [
+            {"user": {"username": "user2"}, "hops": 1},
+            {"user": {"username": "user3"}, "hops": 2},
+        ]
+        assert result.data["debtComponents"] == [
+            {
+                "size": 3,
+                "users": [
+                    {"username": "user1"},
+                    {"username": "user2"},
+                    {"username": "user3"},
+                ],
+            }
+        ]
+        assert result.data["debtCycles"] == []
+
+        # The new debts are added to the graph of the process
+        save("user1", "user3", 2)
+        result = schema.execute(query, variables={"username": "user1"})
+        assert result.errors is None
+        cycle = result.data["debtCycles"][0]
+        assert cycle["amount"] == "2.00"
+        assert cycle["debts"][0] == {
+            "lender": {"username": "user2"},
+            "borrower": {"username": "user1"},
+            "amount": "5.00",
+        }
+        assert len(cycle["debts"]) == 3
+
+        result = schema.execute(
+            'query { debtNeighbours(username: "user1", hops: 9) { hops } }'
+        )
+        assert result.errors[0].message == "hops must be between 1 and 6"
+
+
+class TestCycleCancellation:
+    """Tests for the cancellation of the cycles of debts"""
+
+    date = make_aware(datetime.now() + timedelta(days=20))
+
+    def create_debts(self, users):
+        """Create a cycle user1 -> user2 -> user3 -> user1 and a debt of user4"""
+
+        for debtor, creditor, amount in [
+            ("user1", "user2", 5),
+            ("user2", "user3", 3),
+            ("user3", "user1", 4),
+            ("user4", "user1", 2),
+        ]:
+            Debt(
+                lender=users[creditor],
+                borrower=users[debtor],
+                amount=amount,
+                expiration_date=self.date,
+            ).save()
+
+    def test_cancel_cycles(self, users):
+        """Test if the cycles are cancelled without changing the balances"""
+
+        self.create_debts(users)
+        balances = {
+            name: DebtAccumulate.balance(user) for name, user in users.items()
+        }
+
+        assert cancel_cycles(batch_size=1) == (1, 9)
+        assert DebtAccumulate.user_creditors(users["user1"]) == {"user2": 2}
+        assert DebtAccumulate.user_creditors(users["user2"]) == {}
+        assert DebtAccumulate.user_creditors(users["user3"]) == {"user1": 1}
+        assert DebtAccumulate.user_creditors(users["user4"]) == {"user1": 2}
+        assert {
+            name: DebtAccumulate.balance(user) for name, user in users.items()
+        } == balances
+        assert UserBalance.verify() == []
+
+        cancellation = CycleCancellation.objects.get()
+        ids = [users[name].id for name in ("user1", "user2", "user3")]
+        assert (cancellation.users, cancellation.amount) == (ids, 3)
+        assert cancellation.payments.count() == 3
+
+        # The rebuild keeps the cancellations and there are no cycles left
+        rows = DebtAccumulate.objects.order_by("lender_id", "borrower_id")
+        totals = list(rows.values_list("lender_id", "borrower_id", "total_amount"))
+        DebtAccumulate.rebuild()
+        assert list(rows.values_list("lender_id", "borrower_id", "total_amount")) == (
+            totals
+        )
+        assert cancel_cycles() == (0, 0)
+
+    def test_record_current_debts(self, users):
+        """Test if a cycle is cancelled by its current debts"""
+
+        self.create_debts(users)
+        ids = [users[name].id for name in ("user1", "user2", "user3")]
+
+        # The debt of user2 changed after the search
+        [cancellation] = CycleCancellation.record([(ids, Decimal(4))])
+        assert cancellation.amount == 3
+        assert CycleCancellation.record([(ids, Decimal(1))]) == []
+        assert UserBalance.verify() == []
+
+    def test_cancel_debt_cycles_command(self, users):
+        """Test the command in a dry run and cancelling the cycles"""
+
+        self.create_debts(users)
+        out = io.StringIO()
+        call_command("cancel_debt_cycles", "--dry-run", stdout=out)
+        assert "Found 1 cycles, 9.00 in debts" in out.getvalue()
+        assert CycleCancellation.objects.count() == 0
+
+        call_command("cancel_debt_cycles", "--batch-size", "10", stdout=out)
+        assert "Cancelled 1 cycles, 9.00 in debts" in out.getvalue()
+        assert CycleCancellation.objects.count() == 1
+
+        # Without batches every cycle would be cancelled in one transaction
+        with pytest.raises(CommandError):
+            call_command("cancel_debt_cycles", "--batch-size", "0")
+
+
+class TestExpirationScheduler:
+    """Tests for the processing of the debts as they expire"""
+
+    now = make_aware(datetime(2022, 11, 20, 12))
+
+    def create_debt(self, users, amount, hours, created_hours=-48):
+        """Create a debt that expires and is created hours after now"""
+
+        Debt(
+            lender=users["user1"],
+            borrower=users["user2"],
+            amount=amount,
+            expiration_date=self.now + timedelta(hours=hours),
+            created_at=self.now + timedelta(hours=created_hours),
+        ).save()
+
+    @pytest.fixture
+    def expired(self):
+        """Returns the list of (consumer, amounts) of the sent batches"""
+
+        batches = []
+
+        def receiver(sender, debts, name, **kwargs):
+            batches.append((name, [int(debt.amount) for debt in debts]))
+
+        debts_expired.connect(receiver)
+        yield batches
+        debts_expired.disconnect(receiver)
+
+    def test_process_expired(self, users, expired):
+        """Test if every run only sends the debts expired after the previous one"""
+
+        for amount, hours in ((1, -5), (2, 1), (3, 2), (4, 3)):
+            self.create_debt(users, amount, hours)
+
+        # The first run starts the watermark
+        assert process_expired(now=self.now) == 0
+        assert process_expired(batch_size=1, now=self.now + timedelta(hours=3)) == 2
+        assert expired == [("default", [2]), ("default", [3])]
+        assert process_expired(now=self.now + timedelta(hours=3)) == 0
+
+        # A debt created already expired is sent when it is created, unless it
+        # expired before the consumer started
+        self.create_debt(users, 5, 1, created_hours=3)
+        self.create_debt(users, 6, -10, created_hours=3)
+        assert process_expired(now=self.now + timedelta(hours=4)) == 2
+        assert expired[2:] == [("default", [4]), ("default", [5])]
+
+        # Another consumer starts from an earlier time
+        since = self.now - timedelta(hours=6)
+        assert process_expired("other", now=self.now + timedelta(hours=4), since=since)
+        assert expired[4:] == [("other", [1, 2, 3, 4]), ("other", [5])]
+
+    def test_process_imported_debts(self, users, expired, tmp_path):
+        """Test if the imported debts that expired before the consumer aren't sent"""
+
+        assert process_expired() == 0
+        path = tmp_path / "debts.csv"
+        path.write_text(
+            "lender,borrower,amount,expiration\n"
+            "user1,user2,10,2019-01-01\n"
+            "user2,user1,20,2019-02-01\n"
+        )
+        call_command("import_debts", str(path), stdout=io.StringIO())
+
+        assert process_expired(now=timezone.now() + timedelta(hours=1)) == 0
+        assert expired == []
+
+    def test_process_expired_debts_command(self, users, expired):
+        """Test if the command sends the debts since a time"""
+
+        for amount, hours in ((1, -5), (2, 1)):
+            self.create_debt(users, amount, hours)
+
+        out = io.StringIO()
+        call_command("process_expired_debts", "--since", "2022-11-20T00:00", stdout=out)
+        assert "Processed 2 expired debts" in out.getvalue()
+        call_command("process_expired_debts", stdout=out)
+        assert "Processed 0 expired debts" in out.getvalue()
+        assert expired == [("default", [1, 2])]
+
+        with pytest.raises(CommandError):
+            call_command("process_expired_debts", "--since", "yesterday")
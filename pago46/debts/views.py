@@ -1,33 +1,128 @@
 # encoding: utf-8
 """Views of debts app"""
 
+import hashlib
+import json
 from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.http import StreamingHttpResponse
 
 from rest_framework import generics
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import cache
+from .db import reading_from_replica
+from .serializers import DebtSerializer, PaymentSerializer, UserSerializer
+from .models import (
+    SUMMARY_BATCH_SIZE,
+    User,
+    Debt,
+    DebtAccumulate,
+    IdempotencyKey,
+    UserObject,
+    materialized,
+    write_behind,
+)
+from .renderers import NDJSONRenderer, UserRowsRenderer
+from .settlement import net_balances, plan_transfers
+
+# Maximum number of IOUs in a request to /iou/bulk
+BULK_IOU_LIMIT = 10000
+
+
+def create_user_rows(users):
+    """Create the (name, owes, owed_by, balance) of several users with a constant
+    number of queries"""
+    if materialized() and not write_behind() and UserObject.complete():
+        summaries = UserObject.summaries(users)
+    else:
+        summaries = DebtAccumulate.user_summaries(users)
+    rows = []
+    for user in users:
+        owes, owed_by = summaries.get(user.pk, ({}, {}))
+        balance = sum(owed_by.values()) - sum(owes.values())
+        rows.append((user.username, owes, owed_by, balance))
+    return rows
 
-from .serializers import DebtSerializer, UserSerializer
-from .models import User, DebtAccumulate
+
+def create_user_objects(users):
+    """Create the user objects of several users with a constant number of queries"""
+    return [
+        {"name": name, "owes": owes, "owed_by": owed_by, "balance": balance}
+        for name, owes, owed_by, balance in create_user_rows(users)
+    ]
 
 
 def create_user_object(user):
     """Create the user object"""
-    user_object = {
-        "name": user.username,
-        "owes": DebtAccumulate.user_creditors(user),
-        "owed_by": DebtAccumulate.user_debtors(user),
-        "balance": DebtAccumulate.balance(user),
-    }
-    return user_object
+    return create_user_objects([user])[0]
+
+
+def cached_user_objects(users):
+    """Return the user objects of the users, creating only the ones not in the cache"""
+    users = list(users)
+    user_objects, versions = cache.get_user_objects([user.pk for user in users])
+    missing = [user for user in users if user.pk not in user_objects]
+    if missing:
+        ids = [user.pk for user in missing]
+        created = dict(zip(ids, create_user_objects(missing)))
+        # The replica can be behind the commits that changed the versions
+        if not reading_from_replica():
+            cache.set_user_objects(created, versions)
+        user_objects.update(created)
+    return [user_objects[user.pk] for user in users]
+
+
+def stream_user_objects(users, chunk_size=SUMMARY_BATCH_SIZE):
+    """Yield the user objects of a queryset as lines of JSON
+
+    The users are read in chunks and the objects of every chunk are created at once,
+    so the memory doesn't grow with the number of users.
+    """
+    users = users.iterator(chunk_size=chunk_size)
+    chunk = list(islice(users, chunk_size))
+    while chunk:
+        for user_object in create_user_objects(chunk):
+            yield NDJSONRenderer.render_line(user_object)
+        chunk = list(islice(users, chunk_size))
+
+
+class UsernameCursorPagination(CursorPagination):
+    """Pages of users by username
+
+    The next page starts after the last username of the page, instead of counting
+    an offset, so any page costs the same.
+    """
+
+    ordering = "username"
+    page_size_query_param = "page_size"
+    max_page_size = 1000
 
 
 class SettleUpView(generics.ListAPIView):
 
     queryset = User.objects.all()
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
+        NDJSONRenderer,
+        UserRowsRenderer,
+    ]
+    pagination_class = UsernameCursorPagination
 
     def get(self, request):
-        """Return a list of user objects"""
-        user_objects = []
+        """Return a list of user objects
+
+        Without user names the user objects are paginated. With the stream parameter,
+        or asking for NDJSON, the user objects are streamed as they are created, one
+        per line. With the compact format the rows of the users are rendered without
+        the cache.
+        """
         # Obtain the users names from the request, delete blank spaces
         # and filter in the User model.
         users = self.get_queryset()
@@ -40,10 +135,76 @@ class SettleUpView(generics.ListAPIView):
             )
             users = users.filter(username__in=user_names_list).order_by("username")
 
-        for user in users:
-           user_objects.append(create_user_object(user))
+        if (
+            request.query_params.get("stream") in ("1", "true")
+            or request.accepted_renderer.format == NDJSONRenderer.format
+        ):
+            return StreamingHttpResponse(
+                stream_user_objects(users), content_type=NDJSONRenderer.media_type
+            )
 
-        return Response(user_objects)
+        user_objects = cached_user_objects
+        if request.accepted_renderer.format == UserRowsRenderer.format:
+            user_objects = create_user_rows
+
+        if not users_names:
+            page = self.paginate_queryset(users)
+            return self.get_paginated_response(user_objects(page))
+
+        return Response(user_objects(users))
+
+
+class SettleUpPlanView(generics.GenericAPIView):
+    """Transfers that settle the debts of a group of users"""
+
+    queryset = User.objects.all()
+
+    def get(self, request):
+        """Return the transfers that settle the debts between the users
+
+        The optional mode parameter is exact, for the minimum number of transfers,
+        or greedy, by default exact is used for small groups.
+        """
+
+        users = None
+        users_names = request.query_params.get("users")
+        if users_names:
+            user_names_list = list(map(str.strip, users_names.split(",")))
+            users = self.get_queryset().filter(username__in=user_names_list)
+
+        mode = request.query_params.get("mode")
+        if mode not in (None, "exact", "greedy"):
+            raise ValidationError("Invalid value for mode")
+
+        try:
+            transfers = plan_transfers(
+                net_balances(users), exact=None if mode is None else mode == "exact"
+            )
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+        return Response(
+            {
+                "transfers": [
+                    {"from": debtor, "to": creditor, "amount": amount}
+                    for debtor, creditor, amount in transfers
+                ]
+            }
+        )
+
+
+def add_user(data):
+    """Create the user of the data and return its user object"""
+
+    # If there is a user parameter and the username is not repeated
+    # Create a new user and return the user object, else, return nothing
+    if "user" in data:
+        username = data.get("user")
+        if not User.objects.filter(username=username).exists():
+            new_user = User(username=username)
+            new_user.save()
+            return cached_user_objects([new_user])[0]
+    return None
 
 
 class AddUserView(generics.ListCreateAPIView):
@@ -52,15 +213,62 @@ class AddUserView(generics.ListCreateAPIView):
     def post(self, request):
         """Create a new user"""
 
-        # If there is a user parameter and the username is not repeated
-        # Create a new user and return the user object, else, return nothing
-        if "user" in request.data:
-            username = request.data.get("user")
-            if not User.objects.filter(username=username).exists():
-                new_user = User(username=username)
-                new_user.save()
-                return Response(create_user_object(new_user))
-        return Response()
+        return Response(add_user(request.data))
+
+
+def create_iou(data, idempotency_key=None):
+    """Create the debt of an IOU and return the user objects of its users
+
+    With an idempotency key the response is saved, and a request with the same key
+    returns it without creating the debt again.
+    """
+
+    # If there is one parameter missing raise an Exception
+    try:
+        lender = data["lender"]
+        borrower = data["borrower"]
+        amount = data["amount"]
+        expiration = data["expiration"]
+    except KeyError as e:
+        raise KeyError(f"There is no {e} data in the request")
+
+    # Validate the values of amount and expiration
+    try:
+        amount = float(amount)
+    except ValueError:
+        raise ValueError("Invalid value for amount")
+
+    try:
+        expiration_date = datetime.strptime(expiration, "%Y-%M-%d")
+    except ValueError:
+        raise ValueError("Invalid value for expiration")
+
+    # The string of the float has the decimals that were sent
+    entry = {
+        "lender": lender,
+        "borrower": borrower,
+        "amount": Decimal(str(amount)),
+        "expiration_date": expiration_date,
+    }
+
+    # Raise an exception if there is no lender or borrower or the debt isn't valid
+    try:
+        if idempotency_key is None:
+            debt = Debt.record(entry)
+            return {"users": cached_user_objects([debt.lender, debt.borrower])}
+
+        # The response is saved as it is rendered, and created in the transaction
+        # of the debt, without the cache
+        def create():
+            debt = Debt.record(entry)
+            users = create_user_objects([debt.lender, debt.borrower])
+            return json.loads(json.dumps({"users": users}, cls=JSONEncoder))
+
+        request = json.dumps([lender, borrower, str(amount), expiration])
+        fingerprint = hashlib.sha256(request.encode()).hexdigest()
+        return IdempotencyKey.run(idempotency_key, fingerprint, create)
+    except DjangoValidationError as e:
+        raise ValidationError(e.messages)
 
 
 class CreateIOUView(generics.ListCreateAPIView):
@@ -71,51 +279,66 @@ class CreateIOUView(generics.ListCreateAPIView):
     def post(self, request):
         """Create a new debt"""
 
-        # If there is one parameter missing raise an Exception
-        try:
-            lender = request.data["lender"]
-            borrower = request.data["borrower"]
-            amount = request.data["amount"]
-            expiration_date = request.data["expiration"]
-        except KeyError as e:
-            raise KeyError(f"There is no {e} data in the request")
-
-        # Validate the values of amount and expiration
-        try:
-            amount = float(amount)
-        except ValueError:
-            raise ValueError("Invalid value for amount")
+        return Response(
+            create_iou(request.data, request.headers.get("Idempotency-Key"))
+        )
 
-        try:
-            expiration_date = datetime.strptime(expiration_date, "%Y-%M-%d")
-        except ValueError:
-            raise ValueError("Invalid value for expiration")
 
-        # Raise and exception if there is no lender or borrower
-        try:
-            lender = User.objects.get(username=lender)
-        except User.DoesNotExist:
-            raise User.DoesNotExist(f"There is no user {lender}")
+class PayView(generics.GenericAPIView):
+    """Add new payment"""
 
-        try:
-            borrower = User.objects.get(username=borrower)
-        except User.DoesNotExist as u:
-            raise User.DoesNotExist(f"There is no user {borrower}")
-
-        # If there are a lender and a borrower
-        if lender and borrower:
-            debt_data = {
-                "lender": lender.id,
-                "borrower": borrower.id,
-                "amount": amount,
-                "expiration_date": expiration_date,
-            }
-            serializer = self.serializer_class(data=debt_data, many=False)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
+    serializer_class = PaymentSerializer
+
+    def post(self, request):
+        """Create a payment and return the user objects of its users
+
+        The payment is subtracted from the debts between the users.
+        """
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        payment = serializer.save()
+        return Response({"users": cached_user_objects([payment.payer, payment.payee])})
 
-            return Response(
-                {"users": [create_user_object(lender), create_user_object(borrower)]}
-            )
 
-        return Response()
+class BulkCreateIOUView(generics.GenericAPIView):
+    """Add many IOUs at once"""
+
+    def post(self, request):
+        """Create the debts of a list of IOUs
+
+        The invalid IOUs are returned with their errors and the rest are created.
+        """
+
+        ious = request.data
+        if isinstance(ious, dict):
+            ious = ious.get("ious")
+        if not isinstance(ious, list):
+            raise ValidationError("The request must have a list of IOUs")
+        if len(ious) > BULK_IOU_LIMIT:
+            raise ValidationError(f"There can't be more than {BULK_IOU_LIMIT} IOUs")
+
+        # The IOUs have the same parameters as in /iou
+        entries = []
+        for iou in ious:
+            if isinstance(iou, dict):
+                iou = dict(iou)
+                if "expiration" in iou:
+                    iou["expiration_date"] = iou.pop("expiration")
+            entries.append(iou)
+
+        debts, errors = Debt.bulk_record(entries)
+
+        users = {}
+        for debt in debts:
+            users[debt.lender.username] = debt.lender
+            users[debt.borrower.username] = debt.borrower
+        return Response(
+            {
+                "created": len(debts),
+                "errors": [
+                    {"index": index, "errors": messages} for index, messages in errors
+                ],
+                "users": cached_user_objects([users[name] for name in sorted(users)]),
+            }
+        )
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'debts.middleware.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,10 +81,92 @@ WSGI_APPLICATION = 'pago46.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('DEBTS_DB_PATH', BASE_DIR / 'db.sqlite3'),
     }
 }
 
+# With DEBTS_DB_PROFILE=production the connections are kept between requests,
+# they wait for the locks of other connections and SQLite uses WAL, so the reads
+# don't block the writes. The PRAGMAs are set on every new connection.
+DEBTS_DB_PROFILE = os.environ.get('DEBTS_DB_PROFILE', 'development')
+DEBTS_SQLITE_PRAGMAS = None
+if DEBTS_DB_PROFILE == 'production':
+    DATABASES['default'].update(
+        {
+            'CONN_MAX_AGE': int(os.environ.get('DEBTS_CONN_MAX_AGE', 600)),
+            'OPTIONS': {'timeout': float(os.environ.get('DEBTS_DB_TIMEOUT', 20))},
+        }
+    )
+    DEBTS_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    }
+
+# With DEBTS_DB_REPLICA, the path of a copy of the database, the reads of
+# /settleup and the GraphQL queries use the copy and the writes the database
+if os.environ.get('DEBTS_DB_REPLICA'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['DEBTS_DB_REPLICA'],
+    }
+DATABASE_ROUTERS = ['debts.db.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Cache and seconds to keep the user objects of the debts app
+DEBTS_CACHE_ALIAS = 'default'
+DEBTS_CACHE_TIMEOUT = 300
+
+# Milliseconds from which the profile of a request is saved, None disables the
+# profiling, and directory of the profiles
+DEBTS_PROFILE_THRESHOLD_MS = None
+DEBTS_PROFILE_DIR = BASE_DIR / 'profiles'
+
+# Seconds after which the graph of debts of a process is loaded again
+DEBTS_GRAPH_MAX_AGE = 60
+
+# Seconds to keep the responses of the requests with an Idempotency-Key
+DEBTS_IDEMPOTENCY_TIMEOUT = 24 * 60 * 60
+
+# Append the debts to a log that is folded into the accumulated debts later by the
+# fold_debt_deltas command, instead of updating them in every request
+DEBTS_WRITE_BEHIND = False
+
+# Keep the user object of every user in a UserObject row, updated with its debts,
+# and read the user objects from the rows when the write-behind mode is disabled
+# and the rows are complete, after check_user_objects --rebuild
+DEBTS_USER_OBJECTS = False
+
+
+# Logging
+# https://docs.djangoproject.com/en/3.2/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'debts.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
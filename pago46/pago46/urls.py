@@ -3,15 +3,35 @@
 from django.contrib import admin
 from django.urls import path
 from graphene_django.views import GraphQLView
+from debts import async_views
+from debts.db import read_from_replica
 from debts.schema import schema
-from debts.views import SettleUpView, AddUserView, CreateIOUView
+from debts.views import (
+    SettleUpView,
+    SettleUpPlanView,
+    AddUserView,
+    CreateIOUView,
+    BulkCreateIOUView,
+    PayView,
+)
 
 from django.views.decorators.csrf import csrf_exempt
 
 urlpatterns = [
     path("admin/", admin.site.urls),
-    path("expired_iou", csrf_exempt(GraphQLView.as_view(graphiql=True, schema=schema))),
-    path("settleup", SettleUpView.as_view(), name="settleup"),
+    path(
+        "expired_iou",
+        csrf_exempt(
+            read_from_replica(GraphQLView.as_view(graphiql=True, schema=schema))
+        ),
+    ),
+    path("settleup", read_from_replica(SettleUpView.as_view()), name="settleup"),
+    path("settleup/plan", SettleUpPlanView.as_view(), name="settleup-plan"),
     path("add", AddUserView.as_view(), name="add"),
     path("iou", CreateIOUView.as_view(), name="iou"),
+    path("iou/bulk", BulkCreateIOUView.as_view(), name="iou-bulk"),
+    path("pay", PayView.as_view(), name="pay"),
+    path("async/settleup", async_views.settleup, name="async-settleup"),
+    path("async/add", async_views.add, name="async-add"),
+    path("async/iou", async_views.iou, name="async-iou"),
 ]